@@ -4,6 +4,7 @@ from PyQt5 import QtWidgets
 from app.utils.clean_cache import remove_directories
 from app.utils.logging_manager import LoggingManager
 from app.services.image_service import ImageServices
+from app.services.feature_cache import FeatureCache
 from app.processing.harris import HarrisService
 from app.processing.sift import SIFTService
 from app.processing.template_matching import TemplateMatching
@@ -39,6 +40,7 @@ class MainWindowController:
         self.srv = ImageServices()
         self.harris_srv = HarrisService()
         self.sift_srv = SIFTService()
+        self.feature_cache = FeatureCache()
 
         # Connect signals to slots
         self.setupConnections()
@@ -226,10 +228,10 @@ class MainWindowController:
             return
 
         # Extract features from original full-size images
-        self.keypoints_1, self.descriptors_1, time = self.sift_srv.extract_features(self.original_image)
+        self.keypoints_1, self.descriptors_1, time = self.feature_cache.extract_features(self.sift_srv, self.original_image)
 
         if self.second_image is not None:
-            self.keypoints_2, self.descriptors_2, _ = self.sift_srv.extract_features(self.second_image)
+            self.keypoints_2, self.descriptors_2, _ = self.feature_cache.extract_features(self.sift_srv, self.second_image)
 
         # Now create visualizations with resized images
         self._display_sift_features()
@@ -237,18 +239,7 @@ class MainWindowController:
 
     # Adjust keypoints for resized images
     def _adjust_keypoints(self, keypoints, scale_x, scale_y):
-        adjusted = []
-        for kp in keypoints:
-            adjusted.append(cv2.KeyPoint(
-                x=kp.pt[0] * scale_x,
-                y=kp.pt[1] * scale_y,
-                size=kp.size * min(scale_x, scale_y),
-                angle=kp.angle,
-                response=kp.response,
-                octave=kp.octave,
-                class_id=kp.class_id
-            ))
-        return adjusted
+        return keypoints.scale(scale_x, scale_y)
 
     def _display_sift_features(self):
         """Display SIFT features on resized versions of the images."""
@@ -0,0 +1,39 @@
+import numpy as np
+from typing import Tuple
+
+
+def squared_distances(a: np.ndarray, b: np.ndarray, a_sq: np.ndarray = None, b_sq: np.ndarray = None) -> np.ndarray:
+    """(len(a), len(b)) squared Euclidean distances as ||a||² + ||b||² - 2·A·Bᵀ (one matrix multiply)."""
+    if a_sq is None:
+        a_sq = np.einsum('ij,ij->i', a, a)
+    if b_sq is None:
+        b_sq = np.einsum('ij,ij->i', b, b)
+    dist = a @ b.T
+    dist *= -2
+    dist += b_sq[None, :]
+    dist += a_sq[:, None]
+    np.maximum(dist, 0, out=dist)  # Rounding can push identical pairs slightly below zero
+    return dist
+
+
+def top_k(dist: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Column indices and values of the k smallest entries of every row, smallest first (ties by index)."""
+    k = min(k, dist.shape[1])
+    if k < dist.shape[1]:
+        idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(k), dist.shape).copy()
+    values = np.take_along_axis(dist, idx, axis=1)
+    order = np.lexsort((idx, values), axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def normalize_for_ncc(descriptors: np.ndarray) -> np.ndarray:
+    """
+    Mean-center every descriptor and scale it to unit L2 norm, so that the NCC of two descriptors
+    is their dot product. Constant descriptors (zero centered norm) become all zeros: NCC 0.
+    """
+    centered = np.asarray(descriptors, dtype=np.float32)
+    centered = centered - centered.mean(axis=1, keepdims=True)     #compute D-D_mean
+    norm = np.linalg.norm(centered, axis=1, keepdims=True)
+    return np.divide(centered, norm, out=np.zeros_like(centered), where=norm > 0)
@@ -0,0 +1,241 @@
+import cv2
+import numpy as np
+from typing import List, Optional, Tuple
+
+from app.processing.descriptor_distances import squared_distances, top_k
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means on float32 rows. Initial centroids are k distinct random rows; clusters that
+    become empty are re-seeded from random rows. Returns the (k, D) centroids.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    data_sq = np.einsum('ij,ij->i', data, data)
+
+    for _ in range(iterations):
+        labels = np.argmin(squared_distances(data, centroids, a_sq=data_sq), axis=1)
+        counts = np.bincount(labels, minlength=k)
+        order = np.argsort(labels, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        empty = counts == 0
+        sums = np.add.reduceat(data[order], starts[~empty], axis=0)
+        centroids[~empty] = sums / counts[~empty, None]
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()))]
+
+    return centroids
+
+
+class KMeansTree:
+    """
+    Hierarchical k-means tree: every node is split into `branching` children by k-means on the
+    descriptors that reach it, down to `depth` levels, giving up to branching**depth leaves.
+    Nodes are stored level by level; the children of node n on one level are n*branching + c on the next.
+    """
+
+    def __init__(self, branching: int = 32, depth: int = 2, iterations: int = 10,
+                 max_train_samples: int = 100000, seed: int = 0):
+        self.branching = branching
+        self.depth = depth
+        self.iterations = iterations
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.centroids = []  # One (branching**(level + 1), D) array per level
+
+    @property
+    def num_leaves(self) -> int:
+        return len(self.centroids[-1]) if self.centroids else 0
+
+    @property
+    def leaf_centroids(self) -> np.ndarray:
+        return self.centroids[-1]
+
+    def fit(self, descriptors: np.ndarray) -> "KMeansTree":
+        """Train the tree on (a random sample of) the descriptors."""
+        data = np.asarray(descriptors, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        if len(data) > self.max_train_samples:
+            data = data[rng.choice(len(data), self.max_train_samples, replace=False)]
+
+        self.centroids = []
+        nodes = np.zeros(len(data), dtype=np.intp)  # Node of every training row on the current level
+        for level in range(self.depth):
+            num_parents = self.branching ** level
+            level_centroids = np.empty((num_parents * self.branching, data.shape[1]), dtype=np.float32)
+
+            for parent in range(num_parents):
+                members = data[nodes == parent]
+                children = slice(parent * self.branching, (parent + 1) * self.branching)
+                if len(members) == 0:
+                    # Unreachable node: inherit the parent centroid so the tree stays complete
+                    level_centroids[children] = self.centroids[-1][parent] if level else 0
+                    continue
+                centers = kmeans(members, self.branching, self.iterations, seed=self.seed + parent)
+                # Too few members for `branching` clusters: repeat centroids to fill the node
+                level_centroids[children] = centers[np.arange(self.branching) % len(centers)]
+
+            self.centroids.append(level_centroids)
+            nodes = self._descend(data, nodes, level)
+
+        return self
+
+    def assign(self, descriptors: np.ndarray) -> np.ndarray:
+        """Leaf id of every descriptor, following the closest child from the root down."""
+        data = np.asarray(descriptors, dtype=np.float32)
+        nodes = np.zeros(len(data), dtype=np.intp)
+        for level in range(self.depth):
+            nodes = self._descend(data, nodes, level)
+        return nodes
+
+    def _descend(self, data: np.ndarray, nodes: np.ndarray, level: int, block_size: int = 2048) -> np.ndarray:
+        """Closest child on `level` for every row, given its node on the level above."""
+        centroids = self.centroids[level].reshape(-1, self.branching, data.shape[1])
+        children_sq = np.einsum('pbd,pbd->pb', centroids, centroids)
+        result = np.empty(len(data), dtype=np.intp)
+        for start in range(0, len(data), block_size):
+            block, parents = data[start:start + block_size], nodes[start:start + block_size]
+            # ||c||² - 2·c·x for the children of every row's node, (rows, branching)
+            dist = children_sq[parents] - 2 * np.einsum('nbd,nd->nb', centroids[parents], block)
+            result[start:start + block_size] = parents * self.branching + np.argmin(dist, axis=1)
+        return result
+
+
+class DescriptorIndex:
+    """
+    Approximate nearest neighbour index over 128-D SIFT descriptors.
+
+    build() trains a hierarchical k-means tree and files every descriptor under its leaf.
+    query() ranks all leaf centroids for each query and searches only the `checks` closest leaves
+    exactly, so `checks` is the recall/speed knob (checks >= num_leaves is an exact search).
+    Sets smaller than brute_force_below are searched exhaustively with blocked matrix products.
+    """
+
+    def __init__(self, branching: int = 32, depth: int = 2, checks: int = 8,
+                 brute_force_below: int = 5000, seed: int = 0):
+        self.tree = KMeansTree(branching=branching, depth=depth, seed=seed)
+        self.checks = checks
+        self.brute_force_below = brute_force_below
+        self.descriptors = None
+        self._sq_norms = None
+        self._order = None  # Original index of every row of self.descriptors
+        self._offsets = None  # Leaf l owns rows _offsets[l]:_offsets[l + 1]
+
+    def __len__(self) -> int:
+        return 0 if self.descriptors is None else len(self.descriptors)
+
+    @property
+    def is_brute_force(self) -> bool:
+        return len(self) < self.brute_force_below
+
+    def build(self, descriptors: np.ndarray) -> "DescriptorIndex":
+        """Index the descriptors (rows of an (N, 128) array). Query results refer to these row numbers."""
+        data = np.ascontiguousarray(descriptors, dtype=np.float32)
+
+        if len(data) < self.brute_force_below:
+            self._order = np.arange(len(data))
+            self._offsets = np.array([0, len(data)])
+        else:
+            leaves = self.tree.fit(data).assign(data)
+            self._order = np.argsort(leaves, kind='stable')
+            data = data[self._order]
+            self._offsets = np.concatenate([[0], np.cumsum(np.bincount(leaves, minlength=self.tree.num_leaves))])
+
+        self.descriptors = data
+        self._sq_norms = np.einsum('ij,ij->i', data, data)
+        return self
+
+    def query(self, queries: np.ndarray, k: int = 2, checks: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k approximate nearest neighbours of every query.
+        Returns (Q, k) indices into the built descriptors (-1 if fewer than k were found) and
+        (Q, k) squared Euclidean distances (inf where no neighbour was found), closest first.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        checks = self.checks if checks is None else checks
+
+        if self.is_brute_force or checks >= self.tree.num_leaves:
+            idx, dist = self._exact_query(queries, k)
+        else:
+            idx, dist = self._tree_query(queries, k, checks)
+
+        found = idx >= 0
+        idx[found] = self._order[idx[found]]
+        return idx, dist
+
+    def knn_match(self, queries: np.ndarray, k: int = 2, checks: Optional[int] = None) -> List[List[cv2.DMatch]]:
+        """query() results as DMatch lists (distance = SSD), like SIFTService.knn_match."""
+        idx, dist = self.query(queries, k, checks)
+        return [[cv2.DMatch(_queryIdx=i, _trainIdx=j, _distance=d) for j, d in zip(row_idx, row_dist) if j >= 0]
+                for i, (row_idx, row_dist) in enumerate(zip(idx.tolist(), dist.tolist()))]
+
+    def estimate_recall(self, queries: np.ndarray, checks: Optional[int] = None) -> float:
+        """Fraction of queries whose approximate nearest neighbour is the exact one."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        approx, _ = self.query(queries, 1, checks)
+        exact, _ = self._exact_query(queries, 1)
+        return float(np.mean(approx[:, 0] == self._order[exact[:, 0]]))
+
+    def _exact_query(self, queries: np.ndarray, k: int, block_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        idx = np.empty((len(queries), min(k, len(self))), dtype=np.intp)
+        dist = np.empty(idx.shape, dtype=np.float32)
+        for start in range(0, len(queries), block_size):
+            block = squared_distances(queries[start:start + block_size], self.descriptors, b_sq=self._sq_norms)
+            idx[start:start + block_size], dist[start:start + block_size] = top_k(block, k)
+        return self._pad(idx, dist, k)
+
+    def _tree_query(self, queries: np.ndarray, k: int, checks: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Leaves to search for every query: the `checks` closest non-empty leaf centroids
+        leaf_dist = squared_distances(queries, self.tree.leaf_centroids)
+        leaf_dist[:, np.diff(self._offsets) == 0] = np.inf
+        probes, _ = top_k(leaf_dist, checks)
+
+        query_sq = np.einsum('ij,ij->i', queries, queries)
+
+        # Visit every probed leaf once, with all the queries that probe it
+        pair_query = np.repeat(np.arange(len(queries)), probes.shape[1])
+        pair_leaf = probes.ravel()
+        order = np.argsort(pair_leaf, kind='stable')
+        pair_query, pair_leaf = pair_query[order], pair_leaf[order]
+        bounds = np.flatnonzero(np.diff(pair_leaf)) + 1
+
+        cand_query, cand_idx, cand_dist = [], [], []
+        for group in np.split(np.arange(len(pair_leaf)), bounds):
+            leaf = pair_leaf[group[0]]
+            lo, hi = self._offsets[leaf], self._offsets[leaf + 1]
+            if lo == hi:
+                continue
+            q = pair_query[group]
+            block = squared_distances(queries[q], self.descriptors[lo:hi], query_sq[q], self._sq_norms[lo:hi])
+            leaf_idx, leaf_dist = top_k(block, k)
+            cand_query.append(np.repeat(q, leaf_idx.shape[1]))
+            cand_idx.append(leaf_idx.ravel() + lo)
+            cand_dist.append(leaf_dist.ravel())
+
+        best_idx = np.full((len(queries), k), -1, dtype=np.intp)
+        best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if not cand_query:
+            return best_idx, best_dist
+
+        # Merge the candidates of all probed leaves: k closest per query
+        cand_query, cand_idx, cand_dist = np.concatenate(cand_query), np.concatenate(cand_idx), np.concatenate(cand_dist)
+        order = np.lexsort((cand_idx, cand_dist, cand_query))
+        cand_query, cand_idx, cand_dist = cand_query[order], cand_idx[order], cand_dist[order]
+        first = np.searchsorted(cand_query, cand_query)  # Start of each query's run
+        rank = np.arange(len(cand_query)) - first
+        keep = rank < k
+        best_idx[cand_query[keep], rank[keep]] = cand_idx[keep]
+        best_dist[cand_query[keep], rank[keep]] = cand_dist[keep]
+
+        return best_idx, best_dist
+
+    @staticmethod
+    def _pad(idx: np.ndarray, dist: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Pad results to k columns when the index holds fewer than k descriptors."""
+        missing = k - idx.shape[1]
+        if missing <= 0:
+            return idx, dist
+        return (np.pad(idx, ((0, 0), (0, missing)), constant_values=-1),
+                np.pad(dist, ((0, 0), (0, missing)), constant_values=np.inf))
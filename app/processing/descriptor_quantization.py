@@ -0,0 +1,241 @@
+import cv2
+import numpy as np
+from typing import List, Tuple, Union
+
+from app.processing.descriptor_distances import squared_distances, top_k
+from app.processing.descriptor_index import kmeans
+
+
+class ScalarQuantizer:
+    """
+    uint8 scalar quantization: every dimension is mapped linearly from its trained [min, max] range
+    to 0..255 (128 bytes per SIFT descriptor instead of 512, 4x smaller).
+    """
+
+    def __init__(self):
+        self.minimum = None
+        self.scale = None
+
+    @property
+    def code_size(self) -> int:
+        return len(self.minimum)
+
+    def fit(self, descriptors: np.ndarray) -> "ScalarQuantizer":
+        data = np.asarray(descriptors, dtype=np.float32)
+        self.minimum = data.min(axis=0)
+        self.scale = np.maximum(data.max(axis=0) - self.minimum, 1e-12) / 255
+        return self
+
+    def encode(self, descriptors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(descriptors, dtype=np.float32) - self.minimum) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return (codes * self.scale + self.minimum).astype(np.float32)
+
+    def distances(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """
+        (Q, N) squared distances from uncompressed queries to the decoded codes, without decoding:
+        ||(q - min) - scale·c||² = ||q - min||² - 2·((q - min)·scale)·cᵀ + ||scale·c||².
+        """
+        shifted = np.asarray(queries, dtype=np.float32) - self.minimum
+        codes = codes.astype(np.float32)  # Exact for 0..255; the only (N, D) temporary
+        return squared_distances(shifted * self.scale, codes,
+                                 a_sq=np.einsum('ij,ij->i', shifted, shifted),
+                                 b_sq=np.einsum('ij,ij,j->i', codes, codes, self.scale * self.scale))
+
+    def state(self) -> dict:
+        return {"minimum": self.minimum, "scale": self.scale}
+
+    def load_state(self, state) -> "ScalarQuantizer":
+        self.minimum, self.scale = state["minimum"], state["scale"]
+        return self
+
+
+class ProductQuantizer:
+    """
+    Product quantization: the descriptor is split into `num_subspaces` sub-vectors and each one is
+    replaced by the id of its nearest centroid in a trained per-subspace codebook of 256 entries
+    (one byte per subspace: 16 subspaces = 16 bytes per descriptor, 32x smaller).
+    Distances to codes are asymmetric: the query stays exact and is compared through lookup tables.
+    """
+
+    def __init__(self, num_subspaces: int = 16, iterations: int = 10, max_train_samples: int = 20000, seed: int = 0):
+        self.num_subspaces = num_subspaces
+        self.num_centroids = 256
+        self.iterations = iterations
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.codebooks = None  # (num_subspaces, 256, sub_dim)
+
+    @property
+    def code_size(self) -> int:
+        return self.num_subspaces
+
+    def fit(self, descriptors: np.ndarray) -> "ProductQuantizer":
+        data = np.asarray(descriptors, dtype=np.float32)
+        if data.shape[1] % self.num_subspaces:
+            raise ValueError(f"Descriptor length {data.shape[1]} is not divisible by {self.num_subspaces} subspaces")
+        if len(data) > self.max_train_samples:
+            data = data[np.random.default_rng(self.seed).choice(len(data), self.max_train_samples, replace=False)]
+
+        sub_dim = data.shape[1] // self.num_subspaces
+        self.codebooks = np.zeros((self.num_subspaces, self.num_centroids, sub_dim), dtype=np.float32)
+        for j, sub in enumerate(self._split(data)):
+            centroids = kmeans(np.ascontiguousarray(sub), self.num_centroids, self.iterations, seed=self.seed + j)
+            # Fewer samples than centroids: repeat centroids (argmin always picks the first copy)
+            self.codebooks[j] = centroids[np.arange(self.num_centroids) % len(centroids)]
+        return self
+
+    def encode(self, descriptors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        data = np.asarray(descriptors, dtype=np.float32)
+        codes = np.empty((len(data), self.num_subspaces), dtype=np.uint8)
+        for start in range(0, len(data), block_size):
+            for j, sub in enumerate(self._split(data[start:start + block_size])):
+                codes[start:start + block_size, j] = np.argmin(squared_distances(sub, self.codebooks[j]), axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.num_subspaces)], axis=1)
+
+    def distance_tables(self, queries: np.ndarray) -> np.ndarray:
+        """(Q, num_subspaces, 256) squared distances from every query sub-vector to every centroid."""
+        queries = np.asarray(queries, dtype=np.float32)
+        return np.stack([squared_distances(np.ascontiguousarray(sub), self.codebooks[j])
+                         for j, sub in enumerate(self._split(queries))], axis=1)
+
+    def distances(self, queries: np.ndarray, codes: np.ndarray, tables: np.ndarray = None) -> np.ndarray:
+        """(Q, N) asymmetric squared distances: a sum of table lookups, one per subspace."""
+        tables = self.distance_tables(queries) if tables is None else tables
+        # (subspace, centroid, query) layout: every lookup gathers whole contiguous rows
+        lookup = np.ascontiguousarray(tables.transpose(1, 2, 0))
+        dist = np.zeros((len(codes), len(tables)), dtype=np.float32)
+        for j in range(self.num_subspaces):
+            dist += lookup[j][codes[:, j]]
+        return dist.T
+
+    def state(self) -> dict:
+        return {"codebooks": self.codebooks}
+
+    def load_state(self, state) -> "ProductQuantizer":
+        self.codebooks = state["codebooks"]
+        self.num_subspaces = self.codebooks.shape[0]
+        return self
+
+    def _split(self, data: np.ndarray) -> List[np.ndarray]:
+        return np.split(data, self.num_subspaces, axis=1)
+
+
+class CompressedDescriptorGallery:
+    """
+    Descriptor gallery kept in RAM only as quantized codes; the exact float32 descriptors live in an
+    .npy file on disk. search() ranks the whole gallery with asymmetric distances on the codes and
+    re-ranks a shortlist of `shortlist` candidates per query with exact SSD on rows read from disk.
+    """
+
+    def __init__(self, quantizer: Union[ScalarQuantizer, ProductQuantizer] = None,
+                 memory_budget: int = 64 * 1024 * 1024):
+        self.quantizer = quantizer if quantizer is not None else ProductQuantizer()
+        self.memory_budget = memory_budget  # Bytes of working memory per step of the code scan
+        self.codes = None
+        self.exact_path = None
+
+    def __len__(self) -> int:
+        return 0 if self.codes is None else len(self.codes)
+
+    @property
+    def memory_bytes(self) -> int:
+        return 0 if self.codes is None else self.codes.nbytes
+
+    @property
+    def compression_ratio(self) -> float:
+        """Size of float32 descriptors divided by the size of their codes."""
+        return 0.0 if self.codes is None else len(self) * self._exact().shape[1] * 4 / self.memory_bytes
+
+    def build(self, descriptors: np.ndarray, exact_path: str, train_samples: np.ndarray = None) -> "CompressedDescriptorGallery":
+        """
+        Train the quantizer (on train_samples, or the descriptors themselves), encode the descriptors
+        and write their exact values to exact_path (.npy) for re-ranking.
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        self.quantizer.fit(descriptors if train_samples is None else train_samples)
+        self.codes = self.quantizer.encode(descriptors)
+        np.save(exact_path, descriptors)
+        self.exact_path = exact_path if exact_path.endswith(".npy") else exact_path + ".npy"
+        return self
+
+    def search(self, queries: np.ndarray, k: int = 2, shortlist: int = 32) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest gallery descriptors of every query: (Q, k) indices and exact squared distances,
+        closest first. Larger shortlists trade speed for recall.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        candidates = self._shortlist(queries, max(shortlist, k))
+
+        # Exact re-ranking with descriptors read from disk (only the shortlisted rows)
+        rows, inverse = np.unique(candidates, return_inverse=True)
+        exact = np.asarray(self._exact()[rows])
+        candidate_vectors = exact[inverse.reshape(candidates.shape)]  # (Q, shortlist, D)
+        dist = np.sum((candidate_vectors - queries[:, None, :]) ** 2, axis=2)
+
+        order, best = top_k(dist, k)
+        return np.take_along_axis(candidates, order, axis=1), best
+
+    def knn_match(self, queries: np.ndarray, k: int = 2, shortlist: int = 32) -> List[List[cv2.DMatch]]:
+        """search() results as DMatch lists (distance = exact SSD)."""
+        idx, dist = self.search(queries, k, shortlist)
+        return [[cv2.DMatch(_queryIdx=i, _trainIdx=j, _distance=d) for j, d in zip(row_idx, row_dist)]
+                for i, (row_idx, row_dist) in enumerate(zip(idx.tolist(), dist.tolist()))]
+
+    def estimate_recall(self, queries: np.ndarray, shortlist: int = 32) -> Tuple[float, float]:
+        """
+        Match quality against exhaustive exact search: recall@1 of the codes alone and after re-ranking.
+        Reads the whole exact gallery, so run it on a sample of queries.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        exact_nn = np.argmin(squared_distances(queries, np.asarray(self._exact())), axis=1)
+        codes_nn = self._shortlist(queries, 1)[:, 0]
+        reranked_nn = self.search(queries, 1, shortlist)[0][:, 0]
+        return float(np.mean(codes_nn == exact_nn)), float(np.mean(reranked_nn == exact_nn))
+
+    def save(self, path: str):
+        """Store the codes, the quantizer state and the location of the exact descriptors."""
+        kind = "pq" if isinstance(self.quantizer, ProductQuantizer) else "sq"
+        np.savez(path, kind=kind, codes=self.codes, exact_path=self.exact_path, **self.quantizer.state())
+
+    def load(self, path: str) -> "CompressedDescriptorGallery":
+        with np.load(path) as data:
+            self.quantizer = (ProductQuantizer() if str(data["kind"]) == "pq" else ScalarQuantizer()).load_state(data)
+            self.codes = data["codes"]
+            self.exact_path = str(data["exact_path"])
+        return self
+
+    def _exact(self) -> np.ndarray:
+        return np.load(self.exact_path, mmap_mode='r')
+
+    def _shortlist(self, queries: np.ndarray, shortlist: int) -> np.ndarray:
+        """(Q, shortlist) gallery indices with the smallest asymmetric distances."""
+        shortlist = min(shortlist, len(self))
+        best_idx = np.empty((len(queries), 0), dtype=np.intp)
+        best_dist = np.empty((len(queries), 0), dtype=np.float32)
+        tables = self.quantizer.distance_tables(queries) if isinstance(self.quantizer, ProductQuantizer) else None
+
+        # Per gallery row: the codes as float32 (scalar quantizer) and, per query, the float32
+        # distance plus lookup/argpartition temporaries
+        row_bytes = 4 * self.quantizer.code_size + 16 * max(len(queries), 1)
+        chunk = max(shortlist, int(self.memory_budget // row_bytes))
+        for start in range(0, len(self), chunk):
+            codes = self.codes[start:start + chunk]
+            if tables is not None:
+                dist = self.quantizer.distances(queries, codes, tables)
+            else:
+                dist = self.quantizer.distances(queries, codes)
+            idx, dist = top_k(dist, shortlist)
+
+            # Keep the running shortlist
+            cand_idx = np.concatenate([best_idx, idx + start], axis=1)
+            cand_dist = np.concatenate([best_dist, dist], axis=1)
+            keep, best_dist = top_k(cand_dist, shortlist)
+            best_idx = np.take_along_axis(cand_idx, keep, axis=1)
+
+        return best_idx
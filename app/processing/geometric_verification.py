@@ -0,0 +1,208 @@
+import numpy as np
+from typing import Optional, Tuple, Union
+
+from app.processing.keypoint_set import KeypointSet
+
+
+class GeometricVerifier:
+    """
+    RANSAC verification of descriptor matches with a homography or an affine model.
+
+    Hypotheses are drawn and scored in batches: every batch solves `batch_size` minimal systems at
+    once and measures all of them against all matches with a single broadcasted reprojection.
+    Samples are drawn PROSAC-style from the best matches first (smallest DMatch distance), the pool
+    doubling every batch until it covers every match, and iterations stop as soon as the inlier
+    ratio found so far makes a better model unlikely at the requested confidence.
+    """
+
+    SAMPLE_SIZES = {"homography": 4, "affine": 3}
+
+    def __init__(self, model: str = "homography", threshold: float = 3.0, confidence: float = 0.999,
+                 max_iterations: int = 2000, batch_size: int = 256, seed: int = 0):
+        if model not in self.SAMPLE_SIZES:
+            raise ValueError(f"Unknown model: {model}")
+        self.model = model
+        self.threshold = threshold  # Maximum reprojection error (pixels) of an inlier
+        self.confidence = confidence
+        self.max_iterations = max_iterations
+        self.batch_size = batch_size
+        self.seed = seed
+        self.iterations = 0  # Hypotheses evaluated by the last verify() call
+
+    @property
+    def sample_size(self) -> int:
+        return self.SAMPLE_SIZES[self.model]
+
+    def verify(self, keypoints1: Union[KeypointSet, list], keypoints2: Union[KeypointSet, list],
+               matches: list) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        Fit the model to matches between keypoints1 (query) and keypoints2 (train).
+        Returns the model (3x3 homography or 2x3 affine matrix, None if no model was found)
+        and a boolean inlier mask aligned with matches.
+        """
+        mask = np.zeros(len(matches), dtype=bool)
+        if len(matches) < self.sample_size:
+            self.iterations = 0
+            return None, mask
+
+        query_idx = np.array([m.queryIdx for m in matches], dtype=np.intp)
+        train_idx = np.array([m.trainIdx for m in matches], dtype=np.intp)
+        distance = np.array([m.distance for m in matches], dtype=np.float64)
+        src = KeypointSet.from_cv2(keypoints1).pts[query_idx].astype(np.float64)
+        dst = KeypointSet.from_cv2(keypoints2).pts[train_idx].astype(np.float64)
+
+        model, inliers = self.fit(src, dst, np.argsort(distance, kind='stable'))
+        if model is not None:
+            mask[:] = inliers
+        return model, mask
+
+    def fit(self, src: np.ndarray, dst: np.ndarray, order: np.ndarray = None) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        RANSAC on (N, 2) point correspondences src -> dst. `order` ranks correspondences from most to
+        least reliable for progressive sampling (default: as given). Returns (model, inlier mask).
+        """
+        num_points, sample_size = len(src), self.sample_size
+        order = np.arange(num_points) if order is None else np.asarray(order)
+        rng = np.random.default_rng(self.seed)
+
+        # Normalize both point sets (centroid at 0, mean distance √2) for well-conditioned systems
+        src_n, src_t = self._normalize(src)
+        dst_n, dst_t = self._normalize(dst)
+        threshold_sq = (self.threshold * dst_t[0, 0]) ** 2
+
+        best_model, best_inliers, best_count = None, np.zeros(num_points, dtype=bool), 0
+        required = self.max_iterations
+        pool = min(num_points, max(4 * sample_size, 16))
+        self.iterations = 0
+
+        # Batches start small (good PROSAC samples often succeed at once) and double up to batch_size
+        batch_size = min(self.batch_size, 32)
+        while self.iterations < required:
+            batch = min(batch_size, required - self.iterations)
+            batch_size = min(self.batch_size, 2 * batch_size)
+            samples = order[rng.integers(0, pool, size=(batch, sample_size))]
+            self.iterations += batch
+            pool = min(num_points, 2 * pool)
+
+            models, valid = self._solve_minimal(src_n[samples], dst_n[samples])
+            # Samples that repeat a correspondence are degenerate
+            samples.sort(axis=1)
+            valid &= np.all(samples[:, 1:] != samples[:, :-1], axis=1)
+            if not valid.any():
+                continue
+
+            models = models[valid]
+            inliers = self._errors(models, src_n, dst_n) < threshold_sq  # (batch, N)
+            counts = inliers.sum(axis=1)
+            best = int(np.argmax(counts))
+            if counts[best] > best_count:
+                best_model, best_inliers, best_count = models[best], inliers[best], int(counts[best])
+                required = min(required, self._required_iterations(best_count / num_points))
+
+        if best_model is None or best_count < sample_size:
+            return None, np.zeros(num_points, dtype=bool)
+
+        # Refit on all inliers, then re-measure the consensus with the refined model
+        refined = self._solve_least_squares(src_n[best_inliers], dst_n[best_inliers])
+        if refined is not None:
+            refined_inliers = self._errors(refined[None], src_n, dst_n)[0] < threshold_sq
+            if refined_inliers.sum() >= best_count:
+                best_model, best_inliers = refined, refined_inliers
+
+        return self._denormalize(best_model, src_t, dst_t), best_inliers
+
+    def _required_iterations(self, inlier_ratio: float) -> int:
+        """Hypotheses needed to draw one all-inlier sample with the requested confidence."""
+        all_inliers = inlier_ratio ** self.sample_size
+        if all_inliers >= 1:
+            return 0
+        if all_inliers <= 0:
+            return self.max_iterations
+        return int(np.ceil(np.log(1 - self.confidence) / np.log(1 - all_inliers)))
+
+    @staticmethod
+    def _normalize(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Similarity-normalized points and the 3x3 transform that produced them."""
+        center = points.mean(axis=0)
+        mean_distance = np.mean(np.linalg.norm(points - center, axis=1))
+        scale = np.sqrt(2) / mean_distance if mean_distance > 0 else 1.0
+        transform = np.array([[scale, 0, -scale * center[0]],
+                              [0, scale, -scale * center[1]],
+                              [0, 0, 1]])
+        return (points - center) * scale, transform
+
+    def _solve_minimal(self, src: np.ndarray, dst: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Models of a batch of minimal samples, src/dst of shape (B, sample_size, 2).
+        Returns (B, 3, 3) matrices and a mask of the non-degenerate ones.
+        """
+        batch = len(src)
+        x, y = src[..., 0], src[..., 1]
+        u, v = dst[..., 0], dst[..., 1]
+        ones, zeros = np.ones_like(x), np.zeros_like(x)
+
+        if self.model == "homography":
+            # Two DLT rows per correspondence with h33 = 1: an 8x8 system per sample
+            rows_u = np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=2)
+            rows_v = np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=2)
+            a = np.concatenate([rows_u, rows_v], axis=1)
+            b = np.concatenate([u, v], axis=1)
+        else:
+            # [x y 1] solves both output coordinates: a 3x3 system with two right-hand sides
+            a = np.stack([x, y, ones], axis=2)
+            b = np.stack([u, v], axis=2)
+
+        valid = np.abs(np.linalg.det(a)) > 1e-10
+        a[~valid] = np.eye(a.shape[1])  # Keep the batched solve defined for degenerate samples
+        solution = np.linalg.solve(a, b[..., None] if b.ndim == 2 else b)
+
+        models = np.zeros((batch, 3, 3))
+        models[:, 2, 2] = 1
+        if self.model == "homography":
+            models.reshape(batch, 9)[:, :8] = solution[..., 0]
+        else:
+            models[:, :2, :] = solution.transpose(0, 2, 1)
+        return models, valid
+
+    def _solve_least_squares(self, src: np.ndarray, dst: np.ndarray) -> Optional[np.ndarray]:
+        """Least-squares model of all given correspondences (DLT via SVD for the homography)."""
+        if len(src) < self.sample_size:
+            return None
+        x, y, u, v = src[:, 0], src[:, 1], dst[:, 0], dst[:, 1]
+        ones, zeros = np.ones_like(x), np.zeros_like(x)
+
+        if self.model == "homography":
+            a = np.concatenate([
+                np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y, -u], axis=1),
+                np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y, -v], axis=1),
+            ])
+            model = np.linalg.svd(a, full_matrices=False)[2][-1].reshape(3, 3)
+            if abs(model[2, 2]) < 1e-12:
+                return None
+            return model / model[2, 2]
+
+        solution = np.linalg.lstsq(np.stack([x, y, ones], axis=1), np.stack([u, v], axis=1), rcond=None)[0]
+        return np.vstack([solution.T, [0, 0, 1]])
+
+    @staticmethod
+    def _errors(models: np.ndarray, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        """(B, N) squared reprojection errors of every correspondence under every model."""
+        projected = models[:, :, :2] @ src.T  # (B, 3, N), one batched matrix multiply
+        projected += models[:, :, 2:]
+        u, v, w = projected[:, 0], projected[:, 1], projected[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u /= w
+            v /= w
+            u -= dst[:, 0]
+            v -= dst[:, 1]
+            errors = u * u
+            errors += v * v
+        # Points mapped to infinity (or behind the camera) are never inliers
+        return np.where(np.isfinite(errors) & (w > 0), errors, np.inf)
+
+    def _denormalize(self, model: np.ndarray, src_t: np.ndarray, dst_t: np.ndarray) -> np.ndarray:
+        """Model in pixel coordinates: dst_t⁻¹ · model · src_t."""
+        model = np.linalg.inv(dst_t) @ model @ src_t
+        if self.model == "homography":
+            return model / model[2, 2]
+        return model[:2] / model[2, 2]
@@ -0,0 +1,94 @@
+import cv2
+import numpy as np
+from typing import List, Sequence, Union
+
+
+# One record per keypoint: 24 bytes instead of a full cv2.KeyPoint Python object
+KEYPOINT_DTYPE = np.dtype([
+    ("x", np.float32),
+    ("y", np.float32),
+    ("size", np.float32),
+    ("angle", np.float32),
+    ("response", np.float32),
+    ("octave", np.int32),
+])
+
+
+class KeypointSet:
+    """
+    Compact keypoint container backed by a NumPy structured array (x, y, size, angle, response, octave).
+    Transforms (scale, translate, filter) are vectorized and return new sets; cv2.KeyPoint objects
+    are only built on demand, e.g. by to_cv2() at draw time.
+    Indexing with an integer returns a cv2.KeyPoint, anything else (slice, mask, index array) a KeypointSet.
+    """
+
+    def __init__(self, data: np.ndarray = None):
+        self.data = np.zeros(0, dtype=KEYPOINT_DTYPE) if data is None else np.asarray(data, dtype=KEYPOINT_DTYPE)
+        self._cv2 = None
+
+    @classmethod
+    def from_arrays(cls, x, y, size, angle=-1, response=0, octave=0) -> "KeypointSet":
+        """Build a set from per-field arrays (scalars are broadcast)."""
+        data = np.empty(len(x), dtype=KEYPOINT_DTYPE)
+        data["x"], data["y"], data["size"] = x, y, size
+        data["angle"], data["response"], data["octave"] = angle, response, octave
+        return cls(data)
+
+    @classmethod
+    def from_cv2(cls, keypoints: Union["KeypointSet", Sequence[cv2.KeyPoint]]) -> "KeypointSet":
+        """Wrap a list of cv2.KeyPoint (a KeypointSet is returned as is)."""
+        if isinstance(keypoints, cls):
+            return keypoints
+        return cls(np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave) for kp in keypoints],
+                            dtype=KEYPOINT_DTYPE))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._to_keypoint(self.data[index])
+        return KeypointSet(self.data[index])
+
+    def __iter__(self):
+        return iter(self.to_cv2())
+
+    def __repr__(self) -> str:
+        return f"KeypointSet({len(self)} keypoints)"
+
+    @property
+    def pts(self) -> np.ndarray:
+        """(N, 2) array of (x, y) positions."""
+        return np.column_stack((self.data["x"], self.data["y"]))
+
+    def scale(self, scale_x: float, scale_y: float = None) -> "KeypointSet":
+        """Scale positions per axis; sizes are scaled by the smaller factor."""
+        scale_y = scale_x if scale_y is None else scale_y
+        data = self.data.copy()
+        data["x"] *= scale_x
+        data["y"] *= scale_y
+        data["size"] *= min(scale_x, scale_y)
+        return KeypointSet(data)
+
+    def translate(self, dx: float, dy: float) -> "KeypointSet":
+        """Shift every position by (dx, dy)."""
+        data = self.data.copy()
+        data["x"] += dx
+        data["y"] += dy
+        return KeypointSet(data)
+
+    def filter(self, mask: np.ndarray) -> "KeypointSet":
+        """Keep the keypoints selected by a boolean mask or index array."""
+        return KeypointSet(self.data[mask])
+
+    def to_cv2(self) -> List[cv2.KeyPoint]:
+        """cv2.KeyPoint list for OpenCV drawing functions (built once, then cached)."""
+        if self._cv2 is None:
+            self._cv2 = [self._to_keypoint(record) for record in self.data]
+        return self._cv2
+
+    @staticmethod
+    def _to_keypoint(record) -> cv2.KeyPoint:
+        return cv2.KeyPoint(x=float(record["x"]), y=float(record["y"]), size=float(record["size"]),
+                            angle=float(record["angle"]), response=float(record["response"]),
+                            octave=int(record["octave"]))
@@ -0,0 +1,120 @@
+import os
+import cv2
+import numpy as np
+from typing import Iterator, List, Tuple
+
+from app.processing.descriptor_distances import normalize_for_ncc, squared_distances, top_k
+
+
+class MappedDescriptorGallery:
+    """
+    Out-of-core descriptor gallery: float32 rows appended to a raw file and read back through a
+    memory map, one fixed-size block at a time. Queries stream over the blocks keeping only a running
+    best (and second best) per query, so peak memory depends on the number of queries and
+    memory_budget, never on the size of the gallery.
+    """
+
+    def __init__(self, path: str, dim: int = 128, memory_budget: int = 64 * 1024 * 1024):
+        self.path = path
+        self.dim = dim
+        self.memory_budget = memory_budget  # Bytes of working memory per block (rows, distances, top-k)
+
+    def __len__(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (self.dim * 4)
+
+    def append(self, descriptors: np.ndarray) -> "MappedDescriptorGallery":
+        """Add descriptors at the end of the gallery file (written directly, never held in full)."""
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        if descriptors.ndim != 2 or descriptors.shape[1] != self.dim:
+            raise ValueError(f"Expected (N, {self.dim}) descriptors, got {descriptors.shape}")
+        with open(self.path, "ab") as f:
+            f.write(descriptors.data)
+        return self
+
+    def clear(self):
+        """Delete the gallery file."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def blocks(self, block_rows: int) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yield (start, rows) pairs covering the gallery; only one block is read at a time."""
+        num_rows = len(self)
+        if num_rows == 0:
+            return
+        mapped = np.memmap(self.path, dtype=np.float32, mode='r', shape=(num_rows, self.dim))
+        for start in range(0, num_rows, block_rows):
+            yield start, np.array(mapped[start:start + block_rows])
+
+    def search(self, queries: np.ndarray, k: int = 2, method: str = "SSD") -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest gallery rows of every query: (Q, k) indices and squared distances, closest first
+        (padded with -1 / inf when the gallery is smaller than k). Distances are SSD for "SSD" and
+        2·(1 - NCC) for "NCC", as in SIFTService.knn_match.
+        """
+        if method not in ("SSD", "NCC"):
+            raise ValueError(f"Unknown matching method: {method}")
+        queries = np.asarray(queries, dtype=np.float32)
+        if method == "NCC":
+            queries = normalize_for_ncc(queries)
+        queries_sq = np.einsum('ij,ij->i', queries, queries)
+
+        best_idx = np.full((len(queries), k), -1, dtype=np.intp)
+        best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if len(queries) == 0:
+            return best_idx, best_dist
+
+        for start, block in self.blocks(self._block_rows(len(queries), method)):
+            if method == "NCC":
+                block = normalize_for_ncc(block)
+            dist = squared_distances(queries, block, a_sq=queries_sq)
+            del block  # Freed before the next block is read
+            idx, dist = top_k(dist, k)
+
+            # Merge with the running best; earlier rows come first, so ties keep the lowest index
+            cand_idx = np.concatenate([best_idx, idx + start], axis=1)
+            cand_dist = np.concatenate([best_dist, dist], axis=1)
+            keep, best_dist = top_k(cand_dist, k)
+            best_idx = np.take_along_axis(cand_idx, keep, axis=1)
+
+        return best_idx, best_dist
+
+    def match_features(self, queries: np.ndarray, method: str = "SSD", SSD_threshold: float = 100,
+                       NCC_threshold: float = 0.8) -> list:
+        """SIFTService.match_features against the gallery: best match per query, thresholded."""
+        idx, dist = self.search(queries, 1, method)
+        idx, dist = idx[:, 0], dist[:, 0]
+        if method == "SSD":
+            keep, distance = ~(dist > SSD_threshold), dist
+        else:
+            ncc = 1 - dist / 2
+            keep, distance = ~(ncc < NCC_threshold), -ncc
+        keep &= idx >= 0
+        return [cv2.DMatch(_queryIdx=i, _trainIdx=int(idx[i]), _distance=float(distance[i]))
+                for i in np.flatnonzero(keep).tolist()]
+
+    def knn_match(self, queries: np.ndarray, k: int = 2, method: str = "SSD") -> List[List[cv2.DMatch]]:
+        """SIFTService.knn_match against the gallery."""
+        idx, dist = self.search(queries, k, method)
+        dist = dist / 2 - 1 if method == "NCC" else dist
+        return [[cv2.DMatch(_queryIdx=i, _trainIdx=j, _distance=d) for j, d in zip(row_idx, row_dist) if j >= 0]
+                for i, (row_idx, row_dist) in enumerate(zip(idx.tolist(), dist.tolist()))]
+
+    def ratio_match(self, queries: np.ndarray, ratio: float = 0.8, method: str = "SSD") -> list:
+        """
+        Lowe's ratio test on the streamed best and second best. Unlike SIFTService.ratio_match there
+        is no mutual check: it would need state for every gallery row.
+        """
+        idx, dist = self.search(queries, 2, method)
+        keep = (idx[:, 0] >= 0) & (dist[:, 0] < ratio ** 2 * dist[:, 1])
+        distance = dist[:, 0] / 2 - 1 if method == "NCC" else dist[:, 0]
+        return [cv2.DMatch(_queryIdx=i, _trainIdx=int(idx[i, 0]), _distance=float(distance[i]))
+                for i in np.flatnonzero(keep).tolist()]
+
+    def _block_rows(self, num_queries: int, method: str = "SSD") -> int:
+        """Gallery rows per block so that the whole working set of a block fits in memory_budget."""
+        # Per row: the float32 row (two more copies while normalizing for NCC) and, per query, the
+        # float32 distance plus the int64 indices argpartition returns in top_k
+        row_bytes = (3 if method == "NCC" else 1) * 4 * self.dim + 12 * num_queries
+        return max(1, int(self.memory_budget // row_bytes))
@@ -1,9 +1,42 @@
 import cv2
 import numpy as np
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Callable, Iterable, Union
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage import gaussian_filter
 import time
 
+from app.processing.descriptor_distances import normalize_for_ncc, squared_distances, top_k
+from app.processing.descriptor_pca import DescriptorPCA
+from app.processing.keypoint_set import KeypointSet
+from app.processing import sift_kernels
+
+
+class PyramidArena:
+    """
+    Preallocated float32 storage for the Gaussian and DoG pyramids: one contiguous (scales, H, W)
+    block per octave. Blocks are reused across calls as long as their shape does not change,
+    so extracting features from many images of the same size allocates the pyramids only once.
+    """
+
+    def __init__(self):
+        self._blocks = {}
+
+    def block(self, kind: str, octave_idx: int, shape: Tuple[int, ...]) -> np.ndarray:
+        """Return the block for (kind, octave), reallocating it only when the shape changes."""
+        buffer = self._blocks.get((kind, octave_idx))
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.float32)
+            self._blocks[(kind, octave_idx)] = buffer
+        return buffer
+
+    def clear(self):
+        """Release all blocks."""
+        self._blocks.clear()
+
+
+# Default of update_parameters arguments for which None is a valid value
+_UNCHANGED = object()
+
 
 class SIFTService:
     def __init__(self):
@@ -14,11 +47,29 @@ class SIFTService:
         #keypoint detection
         self.contrast_threshold = 0.04  # Contrast threshold
         self.edge_threshold = 10.0  # Edge threshold
+        self.max_keypoints = 500  # Keypoint budget (strongest |DoG| responses), None keeps all
+        self.keypoints_per_octave = None  # Optional per-octave quota applied before the budget
+        #pyramid construction
+        self.incremental_pyramid = False  # Blur each level from the previous one and seed octaves at 2σ
+        self.arena = PyramidArena()  # Reusable pyramid storage
+        #descriptors
+        self.pyramid_gradients = True  # Describe keypoints from their own pyramid level instead of the full image
+        #parallelism
+        self.num_workers = 1  # Threads used for octaves and descriptor chunks (1 = serial)
+        self.accelerated = sift_kernels.NUMBA_AVAILABLE  # Numba kernels for extrema and histograms when installed
+        self.descriptor_chunk_size = 256  # Keypoints per descriptor task in parallel mode
+        self._executor = None
+        #matching
+        self.match_memory_budget = 64 * 1024 * 1024  # Bytes of distance matrix computed per query block
+        self.pca: Optional[DescriptorPCA] = None  # Fitted projection: shortlist in the reduced space, re-rank exactly
+        self.pca_shortlist = 16  # Candidates per query re-ranked with the full descriptors
 
         
     def update_parameters(self, sigma: float = None, k: int = None,
-                         contrast_threshold: float = None, edge_threshold: float = None):
-        """Update SIFT parameters."""
+                         contrast_threshold: float = None, edge_threshold: float = None,
+                         incremental_pyramid: bool = None, max_keypoints: Optional[int] = _UNCHANGED,
+                         keypoints_per_octave: Optional[int] = _UNCHANGED, num_workers: int = None):
+        """Update SIFT parameters. max_keypoints and keypoints_per_octave accept None (no limit)."""
         if sigma is not None:
             self.sigma = sigma
         if k is not None:
@@ -27,115 +78,247 @@ class SIFTService:
             self.contrast_threshold = contrast_threshold
         if edge_threshold is not None:
             self.edge_threshold = edge_threshold
-
-    def build_gaussian_pyramid(self, image: np.ndarray) -> List[List[np.ndarray]]:
+        if incremental_pyramid is not None:
+            self.incremental_pyramid = incremental_pyramid
+        if max_keypoints is not _UNCHANGED:
+            self.max_keypoints = max_keypoints
+        if keypoints_per_octave is not _UNCHANGED:
+            self.keypoints_per_octave = keypoints_per_octave
+        if num_workers is not None:
+            self.num_workers = num_workers
+
+    def parameter_tuple(self) -> tuple:
+        """Every parameter that changes the extracted keypoints or descriptors."""
+        return (self.sigma, self.k, self.num_octaves, self.num_scales, self.contrast_threshold,
+                self.edge_threshold, self.max_keypoints, self.keypoints_per_octave,
+                self.incremental_pyramid, self.pyramid_gradients)
+
+    def _map(self, fn: Callable, items: Iterable) -> list:
+        """
+        Apply fn to every item, in a thread pool when num_workers > 1.
+        Results always come back in input order, so parallel runs are deterministic.
+        """
+        if self.num_workers <= 1:
+            return [fn(item) for item in items]
+
+        if self._executor is None or self._executor._max_workers != self.num_workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        return list(self._executor.map(fn, items))
+
+    def close(self):
+        """Shut down the worker pool, if one was started."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def build_gaussian_pyramid(self, image: np.ndarray) -> List[np.ndarray]:
         """
         creates a pyramid structure where each octave represents a different resolution level
         for every Octave we get different Scales (apply gaussian blur)/ blurred images
-        Returns list of octaves, each containing gaussian blurred images.
+        Returns list of octaves, each one a contiguous float32 (scales, H, W) block of gaussian blurred images.
+        The blocks live in self.arena and are overwritten by the next pyramid of the same size.
         """
 
         image = image.astype('float32')
 
+        if self.incremental_pyramid:
+            return self._build_incremental_gaussian_pyramid(image)
+
+        # Downsample image for each octave -> halving resolution
+        octave_bases = [image]
+        for octave in range(1, self.num_octaves): # Octave = Resolution (row)
+            image = cv2.resize(image, (image.shape[1]//2, image.shape[0]//2))
+            octave_bases.append(image)
+
+        # Octaves are independent once downsampled
+        return self._map(lambda octave: self._blur_octave(octave, octave_bases[octave]), range(self.num_octaves))
+
+    def _blur_octave(self, octave: int, image: np.ndarray) -> np.ndarray:
+        """Fill the arena block of one octave with its gaussian blurred scales."""
+        octave_images = self.arena.block("gaussian", octave, (self.num_scales,) + image.shape)
+
+        # Generate "scales" for this octave
+        current_sigma = self.sigma
+        for scale in range(self.num_scales):
+            # Applying Gaussian blur with increasing sigma values (σ, σk, σk²,...) at each scale
+            cv2.GaussianBlur(image, (0, 0), current_sigma, dst=octave_images[scale])
+            current_sigma *= self.k
+
+        return octave_images
+
+    def _build_incremental_gaussian_pyramid(self, image: np.ndarray) -> List[np.ndarray]:
+        """
+        Same scales as build_gaussian_pyramid (σ, σk, σk²,...), but every level is blurred from the
+        previous one with the incremental sigma sqrt(σ₂² - σ₁²), so kernel sizes stay small.
+        Each new octave is seeded from the level at 2σ, decimated by taking every other pixel.
+        """
+        sigmas = [self.sigma * self.k ** scale for scale in range(self.num_scales)]
+
+        # Level closest to 2σ from below, topped up to exactly 2σ if no level sits there
+        seed_idx = max(i for i, s in enumerate(sigmas) if s <= 2 * self.sigma * (1 + 1e-6))
+        seed_delta = np.sqrt(max((2 * self.sigma) ** 2 - sigmas[seed_idx] ** 2, 0.0))
+
         pyramid = []
+        octave_images = self.arena.block("gaussian", 0, (self.num_scales,) + image.shape)
+        cv2.GaussianBlur(image, (0, 0), sigmas[0], dst=octave_images[0])
 
         for octave in range(self.num_octaves): # Octave = Resolution (row)
-            octave_images = []
-
-            # Downsample image for each octave -> halving resolution
-            if octave > 0:
-                image = cv2.resize(image, (image.shape[1]//2, image.shape[0]//2))
-            
             # Generate "scales" for this octave
-            current_sigma = self.sigma
-            for scale in range(self.num_scales):
-                # Applying Gaussian blur with increasing sigma values (σ, σk, σk²,...) at each scale
-                blurred = cv2.GaussianBlur(image, (0, 0), current_sigma)
-                octave_images.append(blurred)
-                current_sigma *= self.k
-                
+            for scale in range(1, self.num_scales):
+                delta = np.sqrt(sigmas[scale] ** 2 - sigmas[scale - 1] ** 2)
+                if delta > 0:
+                    cv2.GaussianBlur(octave_images[scale - 1], (0, 0), delta, dst=octave_images[scale])
+                else:
+                    np.copyto(octave_images[scale], octave_images[scale - 1])
+
             pyramid.append(octave_images)
-            
+
+            # The level at 2σ, halved in resolution, has blur σ relative to the next octave
+            if octave < self.num_octaves - 1:
+                seed = octave_images[seed_idx]
+                if seed_delta > 1e-3:
+                    seed = cv2.GaussianBlur(seed, (0, 0), seed_delta)
+                seed = seed[::2, ::2]
+                octave_images = self.arena.block("gaussian", octave + 1, (self.num_scales,) + seed.shape)
+                np.copyto(octave_images[0], seed)
+
         return pyramid
 
-    def build_dog_pyramid(self, gaussian_pyramid: List[List[np.ndarray]]) -> List[List[np.ndarray]]:
+    def build_dog_pyramid(self, gaussian_pyramid: List[np.ndarray]) -> List[np.ndarray]:
         """
         computes differences between consecutive Gaussian blurred images in same octave (in the same row)
         approximation to the Laplacian of Gaussian
-        Returns list of octaves, each containing DoG images.
+        Returns list of octaves, each one a contiguous float32 (scales - 1, H, W) block of DoG images
+        written in place into self.arena.
+        """
+        def dog_octave(octave_idx: int) -> np.ndarray:
+            octave_images = np.asarray(gaussian_pyramid[octave_idx], dtype=np.float32)
+            dog = self.arena.block("dog", octave_idx, (octave_images.shape[0] - 1,) + octave_images.shape[1:])
+            # Compute difference of consecutive Gaussian blurred images
+            np.subtract(octave_images[1:], octave_images[:-1], out=dog) # DoG for every octave
+            return dog
+
+        return self._map(dog_octave, range(len(gaussian_pyramid)))
+
+    def find_keypoints(self, dog_pyramid: List[np.ndarray]) -> KeypointSet:
+        """
+        Detect scale-space extrema in every octave and keep the strongest ones.
+        Candidates are ranked by |DoG| response over all octaves (optionally capped per octave
+        first) and at most max_keypoints are returned, strongest first, with KeyPoint.response set.
         """
-        dog_pyramid = []
-        
-        for octave_images in gaussian_pyramid:
-            dog_octave = []
-            for i in range(len(octave_images) - 1):
-                # Compute difference of consecutive Gaussian blurred images
-                dog = octave_images[i+1] - octave_images[i]
-                dog_octave.append(dog) # DoG for every octave
-            dog_pyramid.append(dog_octave)
-            
-        return dog_pyramid
-
-    def find_keypoints(self, dog_pyramid: List[List[np.ndarray]]) -> List[cv2.KeyPoint]:
-        keypoints = []
         # print("initial parameters : " , self.sigma , self.k, self.contrast_threshold, self.edge_threshold)
-        for octave_idx, octave in enumerate(dog_pyramid):
-            for scale_idx in range(1, len(octave) - 1):
-                prev, current, next = octave[scale_idx - 1:scale_idx + 2]
-
-                # Pad images to handle borders
-                pad = [(1, 1)] * 2
-                prev_pad = np.pad(prev, pad, 'constant')
-                curr_pad = np.pad(current, pad, 'constant')
-                next_pad = np.pad(next, pad, 'constant')
-
-                h, w = current.shape
-                for i in range(1, h - 1):
-                    for j in range(1, w - 1):
-                        val = current[i, j]
-                        if abs(val) <= self.contrast_threshold:
-                            continue
-
-                        # Check 3x3x3 neighborhood
-                        cube = np.stack([
-                            prev_pad[i:i + 3, j:j + 3],
-                            curr_pad[i:i + 3, j:j + 3],
-                            next_pad[i:i + 3, j:j + 3]
-                        ])
-
-                        is_max = val > 0 and val >= cube.max()
-                        is_min = val < 0 and val <= cube.min()
-                        if not (is_max or is_min):
-                            continue
-
-                        # H = [ Dxx  Dxy ]
-                        #     [ Dxy  Dyy ]
-
-                        # Edge response check , Hessian matrix components (Dxx, Dyy, Dxy)
-                        Dxx = current[i, j + 1] + current[i, j - 1] - 2 * val
-                        Dyy = current[i + 1, j] + current[i - 1, j] - 2 * val
-                        Dxy = (current[i + 1, j + 1] + current[i - 1, j - 1] -
-                               current[i + 1, j - 1] - current[i - 1, j + 1]) / 4
-
-                        trace, det = Dxx + Dyy, Dxx * Dyy - Dxy * Dxy
-                        edge_ratio = (self.edge_threshold + 1) ** 2 / self.edge_threshold
-                        if det <= 0 or trace ** 2 / det >= edge_ratio: #Filters edge responses using curvature ratio: (trace²/det) < threshold
-                            continue
-
-                        # Create keypoint
-                        kp = cv2.KeyPoint()
-                        scale_factor = 2 ** octave_idx      # Stores position scaled by octave factor (2^octave)
-                        kp.pt = (j * scale_factor, i * scale_factor)
-                        current_sigma = self.sigma * (self.k ** scale_idx)
-                        kp.size = current_sigma * scale_factor  # scale_factor = 2^octave_idx
-                        kp.octave = octave_idx
-                        keypoints.append(kp)
-
-        return keypoints[:500]
-
-    def compute_descriptors(self, image: np.ndarray, keypoints: List[cv2.KeyPoint]) -> np.ndarray:
-        if not keypoints:
-            return np.array([])
+        candidates = [c for c in self._map(lambda o: self._octave_candidates(o, dog_pyramid[o]), range(len(dog_pyramid)))
+                      if c is not None]
+        if not candidates:
+            return KeypointSet()
+
+        octave_idx, scale_idx, rows, cols, response = (np.concatenate(c) for c in zip(*candidates))
+
+        # Keypoint budget: the strongest responses over all octaves
+        best = self._strongest(np.abs(response), self.max_keypoints)
+
+        octave_idx, scale_idx, rows, cols = octave_idx[best], scale_idx[best], rows[best], cols[best]
+
+        # Create keypoints
+        scale_factor = 2 ** octave_idx      # Stores position scaled by octave factor (2^octave)
+        current_sigma = self.sigma * (self.k ** scale_idx)
+        return KeypointSet.from_arrays(
+            x=cols * scale_factor,
+            y=rows * scale_factor,
+            size=current_sigma * scale_factor,  # scale_factor = 2^octave_idx
+            response=np.abs(response[best]),  # Ranking strength: minima are as strong as maxima
+            octave=octave_idx | (scale_idx << 8),  # OpenCV packing: octave in the low byte, scale level above it
+        )
+
+    def _octave_candidates(self, octave_idx: int, octave) -> Optional[Tuple[np.ndarray, ...]]:
+        """Keypoint candidates of one octave as (octave, scale, row, column, response) arrays."""
+        # Stack the DoG levels of this octave into one (scales, H, W) volume
+        dog = np.asarray(octave)
+        if dog.shape[0] < 3:
+            return None
+
+        edge_ratio = (self.edge_threshold + 1) ** 2 / self.edge_threshold
+        scale_idx, rows, cols = self._find_octave_extrema(dog, edge_ratio)
+        response = dog[scale_idx, rows, cols]
+
+        # Optional per-octave quota
+        if self.keypoints_per_octave is not None:
+            best = self._strongest(np.abs(response), self.keypoints_per_octave)
+            scale_idx, rows, cols, response = scale_idx[best], rows[best], cols[best], response[best]
+
+        return np.full(len(response), octave_idx), scale_idx, rows, cols, response
+
+    @staticmethod
+    def _strongest(scores: np.ndarray, budget: Optional[int]) -> np.ndarray:
+        """
+        Indices of the `budget` highest scores (all of them if budget is None), highest first.
+        Ties keep their original order so the selection is deterministic.
+        """
+        idx = np.arange(len(scores))
+        if budget is not None and budget < len(scores):
+            idx = np.argpartition(-scores, budget - 1)[:budget] if budget > 0 else idx[:0]
+        return idx[np.lexsort((idx, -scores[idx]))]
+
+    def _find_octave_extrema(self, dog: np.ndarray, edge_ratio: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Whole-array scale-space extremum detection over one DoG octave of shape (scales, H, W).
+        Border voxels (first/last scale, row and column) are never candidates.
+        Returns scale, row and column indices of the surviving keypoints in scan order.
+        """
+        if self.accelerated:
+            return sift_kernels.find_octave_extrema(dog, self.contrast_threshold, edge_ratio)
+
+        inner = dog[1:-1, 1:-1, 1:-1]
+
+        # Contrast pre-mask
+        candidates = np.abs(inner) > self.contrast_threshold
+
+        # Check 3x3x3 neighborhood (the centre voxel is part of its own neighbourhood):
+        # 3x3 dilation/erosion of every level, then max/min over the adjacent levels
+        kernel = np.ones((3, 3), np.uint8)
+        spatial_max = np.stack([cv2.dilate(level, kernel) for level in dog])[:, 1:-1, 1:-1]
+        spatial_min = np.stack([cv2.erode(level, kernel) for level in dog])[:, 1:-1, 1:-1]
+        local_max = np.maximum(np.maximum(spatial_max[:-2], spatial_max[1:-1]), spatial_max[2:])
+        local_min = np.minimum(np.minimum(spatial_min[:-2], spatial_min[1:-1]), spatial_min[2:])
+        is_max = (inner > 0) & (inner >= local_max)
+        is_min = (inner < 0) & (inner <= local_min)
+        candidates &= is_max | is_min
+
+        s, i, j = np.nonzero(candidates)
+        s, i, j = s + 1, i + 1, j + 1
+
+        # H = [ Dxx  Dxy ]
+        #     [ Dxy  Dyy ]
+
+        # Edge response check , Hessian matrix components (Dxx, Dyy, Dxy)
+        val = dog[s, i, j]
+        Dxx = dog[s, i, j + 1] + dog[s, i, j - 1] - 2 * val
+        Dyy = dog[s, i + 1, j] + dog[s, i - 1, j] - 2 * val
+        Dxy = (dog[s, i + 1, j + 1] + dog[s, i - 1, j - 1] -
+               dog[s, i + 1, j - 1] - dog[s, i - 1, j + 1]) / 4
+
+        trace, det = Dxx + Dyy, Dxx * Dyy - Dxy * Dxy
+        # Filters edge responses using curvature ratio: (trace²/det) < threshold
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keep = (det > 0) & ~(trace ** 2 / det >= edge_ratio)
+
+        return s[keep], i[keep], j[keep]
+
+    def compute_descriptors(self, image: np.ndarray, keypoints: Union[KeypointSet, List[cv2.KeyPoint]]) -> np.ndarray:
+        descriptors, _ = self._compute_descriptors(image, keypoints)
+        return descriptors
+
+    def _compute_descriptors(self, image: np.ndarray,
+                             keypoints: Union[KeypointSet, List[cv2.KeyPoint]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Batched descriptor engine: every keypoint that fits inside the image is described at once.
+        Returns the (N, 128) descriptors and the indices of the keypoints they belong to.
+        """
+        if len(keypoints) == 0:
+            return np.array([]), np.array([], dtype=np.intp)
+        keypoints = KeypointSet.from_cv2(keypoints)
 
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
         # Computes x/y gradients
@@ -145,46 +328,134 @@ class SIFTService:
         magnitude = np.sqrt(dx ** 2 + dy ** 2)
         orientation = np.rad2deg(np.arctan2(dy, dx)) % 360
 
-        descriptors = []
-        for kp in keypoints:
-            x, y = map(int, kp.pt)
-            scale = kp.size / self.sigma
-            radius = int(6 * scale)
+        x = keypoints.data["x"].astype(int)
+        y = keypoints.data["y"].astype(int)
+        scale = keypoints.data["size"].astype(np.float64) / self.sigma
+        radius = (6 * scale).astype(int)
+
+        # Check boundary conditions
+        kept = np.flatnonzero((x >= radius) & (x + radius < gray.shape[1]) &
+                              (y >= radius) & (y + radius < gray.shape[0]))
+        if kept.size == 0:
+            return np.array([]), kept
+
+        # Describe the keypoints in chunks when running in parallel, in one batch otherwise
+        chunk_size = self.descriptor_chunk_size if self.num_workers > 1 else kept.size
+        chunks = [kept[i:i + chunk_size] for i in range(0, kept.size, chunk_size)]
+        descriptors = self._map(lambda idx: self._describe_batch(magnitude, orientation, x[idx], y[idx], radius[idx]),
+                                chunks)
+
+        return np.concatenate(descriptors), kept
+
+    def _describe_batch(self, magnitude: np.ndarray, orientation: np.ndarray,
+                        x: np.ndarray, y: np.ndarray, radius: np.ndarray) -> np.ndarray:
+        """(N, 128) descriptors of N in-bounds keypoints from the image gradient maps."""
+        n = len(x)
+
+        # Gather every 16x16 patch (scaled by feature size) into one (N, 16, 16) tensor
+        rows, row_weights = self._patch_sample_grid(y - radius, 2 * radius + 1)
+        cols, col_weights = self._patch_sample_grid(x - radius, 2 * radius + 1)
+        mag_patch = self._sample_patches(magnitude, rows, row_weights, cols, col_weights)
+        ori_patch = self._sample_patches(orientation, rows, row_weights, cols, col_weights)
+
+        if self.accelerated:
+            hist = sift_kernels.orientation_histograms(mag_patch, ori_patch)
+        else:
+            # Build all 4x4 cells x 8-bin orientation histograms (0-360°) with a single scatter-add
+            cell = (np.arange(16) // 4)
+            cell_idx = (cell[:, None] * 4 + cell[None, :]) * 8
+            bins = np.digitize(ori_patch, np.arange(9, dtype=np.float32) * 45) - 1
+            valid = bins < 8  # Orientations outside [0, 360) belong to no bin
+            flat_idx = np.arange(n)[:, None, None] * 128 + cell_idx[None] + np.minimum(bins, 7)
+            hist = np.bincount(flat_idx.ravel(), weights=np.where(valid, mag_patch, 0).ravel(),
+                               minlength=n * 128).astype(np.float32).reshape(n, 128)
+
+        # Normalize descriptors
+        hist /= np.linalg.norm(hist, axis=1, keepdims=True) + 1e-7
+        hist = np.clip(hist, 0, 0.2)
+        hist /= np.linalg.norm(hist, axis=1, keepdims=True) + 1e-7
+
+        return hist
+
+    @staticmethod
+    def _patch_sample_grid(start: np.ndarray, size: np.ndarray, out_size: int = 16) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Source indices and weights of a bilinear resize from `size` to `out_size` samples,
+        using the same pixel-centre mapping and border clamping as cv2.resize (INTER_LINEAR).
+        Returns (N, out_size, 2) indices into the full image and matching (N, out_size, 2) weights.
+        """
+        src = (np.arange(out_size) + 0.5)[None, :] * (size[:, None] / out_size) - 0.5
+        i0 = np.floor(src).astype(int)
+        frac = (src - i0).astype(np.float32)
+        frac[i0 < 0] = 0
+        i0 = np.clip(i0, 0, size[:, None] - 1)
+        i1 = np.minimum(i0 + 1, size[:, None] - 1)
+        idx = np.stack([i0, i1], axis=-1) + start[:, None, None]
+        weights = np.stack([1 - frac, frac], axis=-1)
+        return idx, weights
+
+    @staticmethod
+    def _sample_patches(source: np.ndarray, rows: np.ndarray, row_weights: np.ndarray,
+                        cols: np.ndarray, col_weights: np.ndarray) -> np.ndarray:
+        """Bilinearly sample an (N, 16, 16) patch tensor from `source` on the given grids."""
+        corners = source[rows[:, :, None, :, None], cols[:, None, :, None, :]]  # (N, 16, 16, 2, 2)
+        weights = row_weights[:, :, None, :, None] * col_weights[:, None, :, None, :]
+        return np.sum(corners * weights, axis=(3, 4), dtype=np.float32)
+
+    def _compute_pyramid_descriptors(self, gaussian_pyramid: List[np.ndarray],
+                                     keypoints: Union[KeypointSet, List[cv2.KeyPoint]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Describe keypoints from the gradients of the Gaussian level they were detected at
+        (octave and scale level unpacked from KeyPoint.octave). Gradients are computed once per
+        level that holds keypoints, at that level's resolution, so the patch size no longer grows
+        with the octave. Returns the (N, 128) descriptors and the indices of the described keypoints.
+        """
+        if len(keypoints) == 0:
+            return np.array([]), np.array([], dtype=np.intp)
+        keypoints = KeypointSet.from_cv2(keypoints)
+
+        octave = keypoints.data["octave"] & 255
+        layer = (keypoints.data["octave"] >> 8) & 255
+        octave_scale = 2.0 ** octave
 
-            # Check boundary conditions
-            if (x < radius or x + radius >= gray.shape[1] or
-                    y < radius or y + radius >= gray.shape[0]):
-                continue
+        # Keypoint position and patch radius in the coordinates of its octave
+        x = (keypoints.data["x"] / octave_scale).astype(int)
+        y = (keypoints.data["y"] / octave_scale).astype(int)
+        radius = (6 * keypoints.data["size"].astype(np.float64) / (self.sigma * octave_scale)).astype(int)
 
-            # Extract and resize patches
-            patch = (slice(y - radius, y + radius + 1), slice(x - radius, x + radius + 1))
-            # Extracts 16x16 patch around keypoint (scaled by feature size)
-            mag_patch = cv2.resize(magnitude[patch], (16, 16))
-            ori_patch = cv2.resize(orientation[patch], (16, 16))
+        def describe_level(level_idx: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+            o, l = level_idx
+            level = gaussian_pyramid[o][l]
+            idx = np.flatnonzero((octave == o) & (layer == l))
 
-            # Build histogram
-            hist = np.zeros(128, dtype=np.float32)
+            # Check boundary conditions
+            inside = ((x[idx] >= radius[idx]) & (x[idx] + radius[idx] < level.shape[1]) &
+                      (y[idx] >= radius[idx]) & (y[idx] + radius[idx] < level.shape[0]))
+            idx = idx[inside]
+            if idx.size == 0:
+                return idx, np.empty((0, 128), dtype=np.float32)
 
-            for i in range(4):
-                for j in range(4):
-                    cell_mag = mag_patch[i * 4:(i + 1) * 4, j * 4:(j + 1) * 4]
-                    cell_ori = ori_patch[i * 4:(i + 1) * 4, j * 4:(j + 1) * 4]
+            # Computes x/y gradients of this level only
+            dx = cv2.Sobel(level, cv2.CV_32F, 1, 0, ksize=3)
+            dy = cv2.Sobel(level, cv2.CV_32F, 0, 1, ksize=3)
+            magnitude = np.sqrt(dx ** 2 + dy ** 2)
+            orientation = np.rad2deg(np.arctan2(dy, dx)) % 360
 
-                    # Each cell creates 8-bin orientation histogram (0-360°)
-                    for bin in range(8):
-                        mask = (cell_ori >= bin * 45) & (cell_ori < (bin + 1) * 45)
-                        hist[i * 32 + j * 8 + bin] = cell_mag[mask].sum()
+            return idx, self._describe_batch(magnitude, orientation, x[idx], y[idx], radius[idx])
 
-            # Normalize descriptor
-            hist /= np.linalg.norm(hist) + 1e-7
-            hist = np.clip(hist, 0, 0.2)
-            hist /= np.linalg.norm(hist) + 1e-7
+        levels = sorted(set(zip(octave.tolist(), layer.tolist())))
+        described = self._map(describe_level, levels)
 
-            descriptors.append(hist)
+        kept = np.concatenate([idx for idx, _ in described])
+        if kept.size == 0:
+            return np.array([]), kept
 
-        return np.array(descriptors)
+        # Back to keypoint order
+        order = np.argsort(kept, kind='stable')
+        descriptors = np.concatenate([desc for _, desc in described])
+        return descriptors[order], kept[order]
 
-    def extract_features(self, image: np.ndarray) -> Tuple[List[cv2.KeyPoint], np.ndarray, float]:
+    def extract_features(self, image: np.ndarray) -> Tuple[KeypointSet, np.ndarray, float]:
         """
         Extract SIFT features from an image.
         Returns keypoints, descriptors, and computation time.
@@ -203,19 +474,24 @@ class SIFTService:
         # 3) Find keypoints
         keypoints = self.find_keypoints(dog_pyramid)
 
-        # 4) Compute descriptors
-        descriptors = self.compute_descriptors(image, keypoints)
+        # 4) Compute descriptors (keypoints too close to the border have none and are dropped,
+        # so that descriptor rows and keypoints stay aligned for matching)
+        if self.pyramid_gradients:
+            descriptors, kept = self._compute_pyramid_descriptors(gaussian_pyramid, keypoints)
+        else:
+            descriptors, kept = self._compute_descriptors(image, keypoints)
+        keypoints = keypoints[kept]
 
         computation_time = time.time() - start_time
         print(computation_time)
 
         return keypoints, descriptors, computation_time
 
-    def draw_keypoints(self, image: np.ndarray, keypoints: list) -> np.ndarray:
+    def draw_keypoints(self, image: np.ndarray, keypoints: Union[KeypointSet, list]) -> np.ndarray:
         """Draw keypoints on the image."""
         return cv2.drawKeypoints(
             image,
-            keypoints,
+            KeypointSet.from_cv2(keypoints).to_cv2(),
             None,
             flags=cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS,
             color=(0, 255, 0)
@@ -226,66 +502,196 @@ class SIFTService:
         if len(descriptors1) == 0 or len(descriptors2) == 0:
             return []
 
+        if method not in ("SSD", "NCC"):
+            raise ValueError(f"Unknown matching method: {method}")
+        if self.pca is not None:
+            return self._match_pca(descriptors1, descriptors2, method, SSD_threshold if method == "SSD" else NCC_threshold)
+
+        if method=="SSD":
+            return self._match_ssd(descriptors1, descriptors2, SSD_threshold)
+        return self._match_ncc(descriptors1, descriptors2, NCC_threshold)
+
+    def _match_ssd(self, descriptors1: np.ndarray, descriptors2: np.ndarray, SSD_threshold: float) -> list:
+        """Nearest neighbour by SSD for every query descriptor, kept if its SSD is within the threshold."""
         matches = []
 
-        for i, desc1 in enumerate(descriptors1):
+        for start, ssd in self._ssd_blocks(descriptors1, descriptors2):
+            # Get the index of the descriptor in descriptors2 with the smallest SSD
+            j = np.argmin(ssd, axis=1)
+            distance = ssd[np.arange(len(j)), j]
 
-            if method=="SSD":
-                # Compute SSD to every descriptor in descriptors2
-                ssd = np.sum((descriptors2 - desc1) ** 2, axis=1)
+            #if distance is larger than a threshold, skip it
+            for i in np.flatnonzero(~(distance > SSD_threshold)).tolist():
+                # Create a DMatch object that requires indices of the matched descriptors and their distance
+                matches.append(cv2.DMatch(_queryIdx=start + i, _trainIdx=int(j[i]), _distance=float(distance[i])))
 
-                # Get the index of the descriptor in descriptors2 with the smallest SSD
-                j = np.argmin(ssd)
+        return matches
 
-                # Store the match (i, j)
-                distance = ssd[j]
+    def _match_ncc(self, descriptors1: np.ndarray, descriptors2: np.ndarray, NCC_threshold: float) -> list:
+        """Best NCC match for every query descriptor, kept if its NCC reaches the threshold."""
+        matches = []
 
-                #if distance is larger than a threshold, skip it
-                if distance > SSD_threshold:
-                    continue
+        for start, ncc in self._ncc_blocks(descriptors1, descriptors2):
+            #store max ncc index and value
+            j = np.argmax(ncc, axis=1)
+            best_ncc = ncc[np.arange(len(j)), j]
 
-                # Create a DMatch object that requires indices of the matched descriptors and their distance
-                match = cv2.DMatch(_queryIdx=i, _trainIdx=j, _distance=float(distance))
+            for i in np.flatnonzero(~(best_ncc < NCC_threshold)).tolist():
+                # Create a DMatch object
+                # DMatch sees smaller distance as the better one (higher priority) so we use -similarity for distance
+                matches.append(cv2.DMatch(_queryIdx=start + i, _trainIdx=int(j[i]), _distance=float(-best_ncc[i])))
 
-            elif method=="NCC":
-                desc1 = descriptors1[i]  # shape: (D,)
-                desc1_mean = np.mean(desc1)
-                desc1_centered = desc1 - desc1_mean       #compute D1-D1_mean
+        return matches
 
-                # Initialize best match values
-                ncc_list=[]
+    def _match_pca(self, descriptors1: np.ndarray, descriptors2: np.ndarray, method: str, threshold: float) -> list:
+        """
+        match_features with the PCA prefilter: the pca_shortlist nearest candidates of every query are
+        found in the reduced space, then the best of them is chosen with the exact full-length SSD or NCC
+        and the usual threshold is applied.
+        """
+        if method == "NCC":
+            a, b = normalize_for_ncc(descriptors1), normalize_for_ncc(descriptors2)
+        else:
+            a, b = np.asarray(descriptors1, dtype=np.float32), np.asarray(descriptors2, dtype=np.float32)
+        matches = []
 
-                for j, desc2 in enumerate(descriptors2):
-                    desc2_mean = np.mean(desc2)
-                    desc2_centered = desc2 - desc2_mean    #compute D2-D2_mean
+        # Re-ranking gathers (rows, shortlist, D) candidate vectors, so it runs in budget-sized slices
+        rerank_rows = self._query_block_size(min(self.pca_shortlist, len(b)) * b.shape[1])
+        for start, reduced in self._ssd_blocks(self.pca.transform(descriptors1), self.pca.transform(descriptors2)):
+            candidates, _ = top_k(reduced, self.pca_shortlist)
+
+            for offset in range(0, len(candidates), rerank_rows):
+                cand = candidates[offset:offset + rerank_rows]
+                query = a[start + offset:start + offset + len(cand)]
+                if method == "SSD":
+                    score = np.sum((b[cand] - query[:, None, :]) ** 2, axis=2)
+                    best = np.argmin(score, axis=1)
+                else:
+                    score = np.einsum('ijk,ik->ij', b[cand], query)
+                    best = np.argmax(score, axis=1)
+                rows = np.arange(len(cand))
+                j, value = cand[rows, best], score[rows, best]
+
+                keep = ~(value > threshold) if method == "SSD" else ~(value < threshold)
+                for i in np.flatnonzero(keep).tolist():
+                    distance = value[i] if method == "SSD" else -value[i]
+                    matches.append(cv2.DMatch(_queryIdx=start + offset + i, _trainIdx=int(j[i]), _distance=float(distance)))
 
-                    #build NCC equation
-                    numerator = np.sum(desc1_centered * desc2_centered)
-                    denominator = np.sqrt(np.sum(desc1_centered ** 2) * np.sum(desc2_centered ** 2))
+        return matches
 
-                    ncc = numerator / denominator
+    def _ncc_blocks(self, descriptors1: np.ndarray, descriptors2: np.ndarray):
+        """
+        Yield (start, block) pairs covering the full NCC matrix between descriptors1 and descriptors2,
+        where block[i, j] = NCC(descriptors1[start + i], descriptors2[j]). Both sets are normalized once.
+        """
+        a = normalize_for_ncc(descriptors1)
+        b = normalize_for_ncc(descriptors2)
 
-                    ncc_list.append(ncc)
+        block_size = self._query_block_size(len(b))
+        for start in range(0, len(a), block_size):
+            yield start, a[start:start + block_size] @ b.T
 
-                #store max ncc index and value
-                j=np.argmax(ncc_list)
-                best_ncc=ncc_list[j]
+    def knn_match(self, descriptors1: np.ndarray, descriptors2: np.ndarray, k: int = 2,
+                  method: str = "SSD") -> List[List[cv2.DMatch]]:
+        """
+        The k nearest neighbours in descriptors2 of every descriptor in descriptors1, closest first
+        (like cv2.BFMatcher.knnMatch). Distances are SSD for "SSD" and -NCC for "NCC", as in match_features.
+        """
+        if len(descriptors1) == 0 or len(descriptors2) == 0:
+            return []
 
-                if best_ncc < NCC_threshold:
-                    continue 
+        knn = []
+        for start, dist in self._distance_blocks(descriptors1, descriptors2, method):
+            idx, nearest = top_k(dist, k)
+            nearest = self._match_distance(nearest, method)
+            for i, (row_idx, row_dist) in enumerate(zip(idx.tolist(), nearest.tolist())):
+                knn.append([cv2.DMatch(_queryIdx=start + i, _trainIdx=j, _distance=d) for j, d in zip(row_idx, row_dist)])
 
-                # Create a DMatch object 
-                # DMatch sees smaller distance as the better one (higher priority) so we use -similarity for distance
-                match = cv2.DMatch(_queryIdx=i, _trainIdx=j, _distance=float(-best_ncc))
+        return knn
 
-            matches.append(match)
-   
-        return matches
+    def ratio_match(self, descriptors1: np.ndarray, descriptors2: np.ndarray, ratio: float = 0.8,
+                    mutual: bool = True, method: str = "SSD") -> list:
+        """
+        Nearest neighbour matches filtered by Lowe's ratio test (best distance < ratio x second best,
+        on Euclidean distances) and optionally by a mutual nearest neighbour check.
+        Both filters come from the same blocked distance pass; no second pass over the data is made.
+        """
+        if len(descriptors1) == 0 or len(descriptors2) == 0:
+            return []
 
-    def draw_matches(self, img1: np.ndarray, kp1: list, img2: np.ndarray,
-                    kp2: list, matches: list) -> np.ndarray:
+        num_query, num_train = len(descriptors1), len(descriptors2)
+        best_idx = np.empty(num_query, dtype=np.intp)
+        best_dist = np.empty(num_query, dtype=np.float32)
+        passes_ratio = np.ones(num_query, dtype=bool)
+        # Running best query of every train descriptor, for the mutual check
+        train_best_dist = np.full(num_train, np.inf, dtype=np.float32)
+        train_best_idx = np.full(num_train, -1, dtype=np.intp)
+
+        for start, dist in self._distance_blocks(descriptors1, descriptors2, method):
+            stop = start + len(dist)
+            idx, nearest = top_k(dist, 2)
+            best_idx[start:stop], best_dist[start:stop] = idx[:, 0], nearest[:, 0]
+            if nearest.shape[1] > 1:
+                # Squared distances, so the ratio is squared too
+                passes_ratio[start:stop] = nearest[:, 0] < ratio ** 2 * nearest[:, 1]
+
+            if mutual:
+                block_idx = np.argmin(dist, axis=0)
+                block_best = dist[block_idx, np.arange(num_train)]
+                better = block_best < train_best_dist
+                train_best_dist[better] = block_best[better]
+                train_best_idx[better] = start + block_idx[better]
+
+        keep = passes_ratio
+        if mutual:
+            keep &= train_best_idx[best_idx] == np.arange(num_query)
+
+        distance = self._match_distance(best_dist, method)
+        return [cv2.DMatch(_queryIdx=i, _trainIdx=int(best_idx[i]), _distance=float(distance[i]))
+                for i in np.flatnonzero(keep).tolist()]
+
+    def _distance_blocks(self, descriptors1: np.ndarray, descriptors2: np.ndarray, method: str):
+        """
+        Blocks of squared Euclidean distances shared by the k-NN matchers: the SSD itself for "SSD",
+        and 2·(1 - NCC), the SSD between mean-centered unit descriptors, for "NCC".
+        """
+        if method == "SSD":
+            yield from self._ssd_blocks(descriptors1, descriptors2)
+        elif method == "NCC":
+            for start, ncc in self._ncc_blocks(descriptors1, descriptors2):
+                yield start, 2 * (1 - ncc)
+        else:
+            raise ValueError(f"Unknown matching method: {method}")
+
+    @staticmethod
+    def _match_distance(distance: np.ndarray, method: str) -> np.ndarray:
+        """DMatch distance from a _distance_blocks value (-NCC for NCC, as in match_features)."""
+        return distance / 2 - 1 if method == "NCC" else distance
+
+    def _query_block_size(self, num_train: int, bytes_per_entry: int = 4) -> int:
+        """Number of query rows whose (rows x num_train) score block fits in match_memory_budget."""
+        return max(1, int(self.match_memory_budget // (max(num_train, 1) * bytes_per_entry)))
+
+    def _ssd_blocks(self, descriptors1: np.ndarray, descriptors2: np.ndarray):
+        """
+        Yield (start, block) pairs covering the full SSD matrix between descriptors1 and descriptors2,
+        where block[i, j] = SSD(descriptors1[start + i], descriptors2[j]).
+        Uses ||a||² + ||b||² - 2·A·Bᵀ so each block is a single matrix multiply.
+        """
+        a = np.asarray(descriptors1, dtype=np.float32)
+        b = np.asarray(descriptors2, dtype=np.float32)
+        a_sq = np.einsum('ij,ij->i', a, a)
+        b_sq = np.einsum('ij,ij->i', b, b)
+
+        block_size = self._query_block_size(len(b))
+        for start in range(0, len(a), block_size):
+            stop = start + block_size
+            yield start, squared_distances(a[start:stop], b, a_sq[start:stop], b_sq)
+
+    def draw_matches(self, img1: np.ndarray, kp1: Union[KeypointSet, list], img2: np.ndarray,
+                    kp2: Union[KeypointSet, list], matches: list) -> np.ndarray:
         """Draw matches between two images."""
         return cv2.drawMatches(
-            img1, kp1, img2, kp2, matches, None,
+            img1, KeypointSet.from_cv2(kp1).to_cv2(), img2, KeypointSet.from_cv2(kp2).to_cv2(), matches, None,
             flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS
         )
\ No newline at end of file
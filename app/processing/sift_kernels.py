@@ -0,0 +1,106 @@
+"""
+Optional Numba kernels for the SIFT inner loops.
+
+Each kernel walks the data once with scalar loops instead of building the whole-array temporaries
+of the NumPy path, and returns exactly what that path returns (same float32 arithmetic, same
+order). They are compiled on first use and release the GIL, so SIFTService's thread pool runs them
+in parallel. When Numba is not installed NUMBA_AVAILABLE is False and SIFTService keeps the NumPy path.
+"""
+import os
+from typing import Tuple
+
+import numpy as np
+
+# Compiled kernels are cached under Cache/ at the project root: remove_directories() deletes every
+# __pycache__ (Numba's default location) when the app closes, which would force a re-JIT every session
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "..", "Cache", "numba")))
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    numba = None
+    NUMBA_AVAILABLE = False
+
+
+def find_octave_extrema(dog: np.ndarray, contrast_threshold: float,
+                        edge_ratio: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Kernel version of SIFTService._find_octave_extrema: scale, row and column indices in scan order."""
+    _require_numba()
+    dog = np.ascontiguousarray(dog, dtype=np.float32)
+    flat = _extrema_kernel(dog, np.float32(contrast_threshold), np.float32(edge_ratio))
+    return np.unravel_index(flat, dog.shape)
+
+
+def orientation_histograms(mag_patch: np.ndarray, ori_patch: np.ndarray) -> np.ndarray:
+    """
+    Kernel version of the histogram step of SIFTService._describe_batch: (N, 128) unnormalized
+    4x4 cell x 8 bin histograms of (N, 16, 16) magnitude and orientation (degrees) patches.
+    """
+    _require_numba()
+    return _histogram_kernel(np.ascontiguousarray(mag_patch, dtype=np.float32),
+                             np.ascontiguousarray(ori_patch, dtype=np.float32))
+
+
+def _require_numba():
+    if not NUMBA_AVAILABLE:
+        raise RuntimeError("Numba is not installed; use the NumPy path (SIFTService.accelerated = False)")
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit(cache=True, nogil=True)
+    def _is_extremum(dog, s, i, j, val):
+        """val is >= (maximum) or <= (minimum) every voxel of its 3x3x3 neighbourhood."""
+        for ds in range(-1, 2):
+            for di in range(-1, 2):
+                for dj in range(-1, 2):
+                    neighbour = dog[s + ds, i + di, j + dj]
+                    if (val > 0 and neighbour > val) or (val < 0 and neighbour < val):
+                        return False
+        return True
+
+    @numba.njit(cache=True, nogil=True)
+    def _extrema_kernel(dog, contrast_threshold, edge_ratio):
+        num_scales, height, width = dog.shape
+        two, four = np.float32(2), np.float32(4)
+        found = []
+        for s in range(1, num_scales - 1):
+            for i in range(1, height - 1):
+                for j in range(1, width - 1):
+                    val = dog[s, i, j]
+                    # Contrast pre-mask, then the 26-neighbour comparison
+                    if not abs(val) > contrast_threshold or not _is_extremum(dog, s, i, j, val):
+                        continue
+
+                    # Edge response check on the Hessian (Dxx, Dyy, Dxy)
+                    dxx = dog[s, i, j + 1] + dog[s, i, j - 1] - two * val
+                    dyy = dog[s, i + 1, j] + dog[s, i - 1, j] - two * val
+                    dxy = (dog[s, i + 1, j + 1] + dog[s, i - 1, j - 1] -
+                           dog[s, i + 1, j - 1] - dog[s, i - 1, j + 1]) / four
+                    trace, det = dxx + dyy, dxx * dyy - dxy * dxy
+                    if det > 0 and not trace * trace / det >= edge_ratio:
+                        found.append((s * height + i) * width + j)
+
+        flat = np.empty(len(found), dtype=np.int64)
+        for n in range(len(found)):
+            flat[n] = found[n]
+        return flat
+
+    @numba.njit(cache=True, nogil=True)
+    def _histogram_kernel(mag_patch, ori_patch):
+        edges = np.arange(9).astype(np.float32) * np.float32(45)
+        hist = np.zeros((mag_patch.shape[0], 128), dtype=np.float64)
+        for n in range(mag_patch.shape[0]):
+            for r in range(16):
+                for c in range(16):
+                    # np.digitize semantics: last edge that is <= the orientation
+                    angle = ori_patch[n, r, c]
+                    b = -1
+                    for e in range(9):
+                        if angle >= edges[e]:
+                            b = e
+                    # Orientations outside [0, 360) belong to no bin
+                    if 0 <= b < 8:
+                        hist[n, ((r // 4) * 4 + c // 4) * 8 + b] += mag_patch[n, r, c]
+        return hist.astype(np.float32)
@@ -1,10 +1,20 @@
+import os
+import time
 import cv2
 import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cached_property
+from threading import Lock
+from scipy import fft
 
 class TemplateMatching:
 
     @staticmethod
-    def match_template(image, template, method="NCC"):
+    def match_template(image, template, method="NCC", pyramid_levels=0, candidates=5):
+        """
+        Draw a box around the best match of the template on the image (red for SSD, green for NCC).
+        With pyramid_levels > 0 the search runs coarse-to-fine (see pyramid_match).
+        """
 
         output=image #initialize
         # Convert image and temp to grayscale if needed
@@ -18,49 +28,436 @@ class TemplateMatching:
         h, w = template.shape
 
         if method=="SSD":
-            #initialize ssd array (assume no padding and that template is completely inside the image)
-            ssd_map = np.zeros((img_h - h + 1, img_w - w + 1), dtype=np.float32)
+            if pyramid_levels:
+                top_left, _, _ = TemplateMatching.pyramid_match(image, template, "SSD", pyramid_levels, candidates)
+            else:
+                # SSD value of the window whose top-left corner is at (x, y), for every (x, y) where the template fits
+                ssd_map = TemplateMatching.ssd_map(image, template)
 
-            # Slide the window and calculate SSD
-            for y in range(ssd_map.shape[0]):
-                for x in range(ssd_map.shape[1]):
-                    window = image[y:y + h, x:x + w]
-                    diff = (window.astype(np.float32) - template.astype(np.float32))
-                    ssd = np.sum(diff ** 2)
-                    ssd_map[y, x] = ssd  #stores the SSD value for the window whose top-left corner is at (x, y).
+                # Find the position with minimum SSD
+                min_loc = np.unravel_index(np.argmin(ssd_map), ssd_map.shape)   #gives coordinates as in (y,x) ---> row,col
 
-            # Find the position with minimum SSD
-            min_loc = np.unravel_index(np.argmin(ssd_map), ssd_map.shape)   #gives coordinates as in (y,x) ---> row,col
-
-            top_left = min_loc[::-1]  # switch coordinates order to be (x, y) --> col, row
+                top_left = min_loc[::-1]  # switch coordinates order to be (x, y) --> col, row
             bottom_right = (top_left[0] + template.shape[1], top_left[1] + template.shape[0])
             cv2.rectangle(output, top_left, bottom_right, (0, 0, 255), 2)
 
         elif method=="NCC":
-            ncc_map = np.zeros((img_h - h + 1, img_w - w + 1), dtype=np.float32)
+            if pyramid_levels:
+                top_left, _, _ = TemplateMatching.pyramid_match(image, template, "NCC", pyramid_levels, candidates)
+            else:
+                # Location of max NCC (best match) as (x, y)
+                ncc_map, top_left = TemplateMatching.match_ncc(image, template)
+            bottom_right = (top_left[0] + w, top_left[1] + h)
+            cv2.rectangle(output, top_left, bottom_right, (0, 255, 0), 2)
 
-            # Precompute template normalization terms
-            template = template.astype(np.float32)
-            template_mean = np.mean(template)
-            template_centered = (template - template_mean)
+        return output
 
-            for y in range(ncc_map.shape[0]):
-                for x in range(ncc_map.shape[1]):
-                    window = image[y:y + h, x:x + w].astype(np.float32)
-                    window_mean = np.mean(window)
-                
-                    window_centered = (window - window_mean)
+    @staticmethod
+    def ssd_map(image, template):
+        """
+        SSD map of the template over the image (no padding: one value per position where the
+        template fits), computed as Σw² − 2·(I⋆T) + ΣT². The window sums of squares come from an
+        integral image and the cross-correlation I⋆T from a single FFT product.
+        """
+        return PreparedImage(image).ssd_map(template)
 
-                    #build NCC equation
-                    numerator = np.sum(window_centered * template_centered)
-                    denominator = np.sqrt(np.sum(window_centered ** 2) * np.sum(template_centered ** 2))
+    @staticmethod
+    def ncc_map(image, template):
+        """
+        NCC map of the template over the image (Lewis' fast normalized cross-correlation).
+        The numerator Σ(w − μw)(T − μT) equals Σ w·(T − μT), one FFT cross-correlation with the
+        zero-mean template; window means and energies come from summed-area tables.
+        Windows (or a template) with zero variance have no defined NCC and get 0.
+        """
+        return PreparedImage(image).ncc_map(template)
 
-                    ncc_map[y, x] = numerator / denominator
+    @staticmethod
+    def match_ncc(image, template):
+        """NCC map and the (x, y) top-left corner of the best match."""
+        ncc_map = TemplateMatching.ncc_map(image, template)
+        y, x = np.unravel_index(np.argmax(ncc_map), ncc_map.shape)
+        return ncc_map, (int(x), int(y))
+
+    @staticmethod
+    def match_templates(image, templates, method="NCC", return_maps=False, num_workers=None):
+        """
+        Match many templates in one image. The image-side work (grayscale, FFT, summed-area tables)
+        is done once, and every template then costs one forward and one inverse FFT, all submitted to
+        a thread pool at once. Same-size templates share their window statistics: the first template of
+        a size computes them and they are released when the last one finishes.
+        Returns, in input order, one score map per template when return_maps is set, otherwise one
+        (top_left, bottom_right, score) best box per template.
+        """
+        if method not in ("SSD", "NCC"):
+            raise ValueError(f"Unknown matching method: {method}")
+
+        prepared = PreparedImage(image)
+        # Computed once here rather than by the first worker threads
+        prepared.spectrum
+        prepared.integral_sq
+        if method == "NCC":
+            prepared.integral
+        templates = [TemplateMatching._gray(template) for template in templates]
+        if not templates:
+            return []
+        groups = {}
+        for idx, template in enumerate(templates):
+            groups.setdefault(template.shape, []).append(idx)
+
+        num_workers = num_workers or min(32, (os.cpu_count() or 1) + 4)  # ThreadPoolExecutor's default
+        # Split the cores between the templates in flight and each template's FFTs
+        fft_workers = max(1, (os.cpu_count() or 1) // min(len(templates), num_workers))
+
+        lock = Lock()
+        window_stats = {}  # Template shape -> Future of its window statistics
+        remaining = {shape: len(indices) for shape, indices in groups.items()}
+
+        def shape_stats(shape):
+            with lock:
+                future = window_stats.get(shape)
+                owner = future is None
+                if owner:
+                    future = window_stats[shape] = Future()
+            if owner:
+                try:
+                    h, w = shape
+                    future.set_result(prepared.window_energy(h, w) if method == "SSD" else prepared.window_variance(h, w))
+                except BaseException as e:
+                    future.set_exception(e)
+            return future.result()
+
+        def match_one(idx):
+            template = templates[idx]
+            try:
+                if method == "SSD":
+                    score_map = prepared.ssd_map(template, shape_stats(template.shape), workers=fft_workers)
+                    y, x = np.unravel_index(np.argmin(score_map), score_map.shape)
+                else:
+                    score_map = prepared.ncc_map(template, shape_stats(template.shape), workers=fft_workers)
+                    y, x = np.unravel_index(np.argmax(score_map), score_map.shape)
+            finally:
+                with lock:
+                    remaining[template.shape] -= 1
+                    if remaining[template.shape] == 0:
+                        window_stats.pop(template.shape, None)
+            if return_maps:
+                return score_map
+            h, w = template.shape
+            return (int(x), int(y)), (int(x) + w, int(y) + h), float(score_map[y, x])
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # Submitted group by group, so few sizes hold window statistics at the same time
+            futures = {idx: executor.submit(match_one, idx) for indices in groups.values() for idx in indices}
+            return [futures[idx].result() for idx in range(len(templates))]
+
+    @staticmethod
+    def pyramid_match(image, template, method="NCC", levels=3, candidates=5, refine_radius=2):
+        """
+        Coarse-to-fine search. Image and template are reduced `levels` times with cv2.pyrDown (fewer
+        when the template would shrink below 8 pixels); the full SSD/NCC map is computed at the
+        coarsest level only. On every finer level just the (2·refine_radius + 1)² neighbourhoods of the
+        `candidates` best positions are scored.
+        Returns the (x, y) top-left corner, its score (SSD or NCC) and a report with the number of
+        positions scored, the number an exhaustive full-resolution search scores, and the skipped fraction.
+        """
+        if method not in ("SSD", "NCC"):
+            raise ValueError(f"Unknown matching method: {method}")
+
+        def score_map(img, tpl):
+            # Higher is better for both methods
+            return TemplateMatching.ncc_map(img, tpl) if method == "NCC" else -TemplateMatching.ssd_map(img, tpl)
+
+        image_levels = [TemplateMatching._gray(image)]
+        template_levels = [TemplateMatching._gray(template)]
+        while len(image_levels) <= levels and min(template_levels[-1].shape) // 2 >= 8:
+            image_levels.append(cv2.pyrDown(image_levels[-1]))
+            template_levels.append(cv2.pyrDown(template_levels[-1]))
+
+        # Exhaustive search at the coarsest level
+        scores = score_map(image_levels[-1], template_levels[-1])
+        evaluated = scores.size
+        h, w = template_levels[-1].shape
+        best = TemplateMatching._top_candidates(scores, candidates, h // 2, w // 2)
+
+        # Refine the candidates level by level
+        for img, tpl in zip(image_levels[-2::-1], template_levels[-2::-1]):
+            h, w = tpl.shape
+            max_y, max_x = img.shape[0] - h, img.shape[1] - w
+            refined = {}
+            for _, x, y in best:
+                x, y = 2 * x, 2 * y
+                # Re-centre and search again while the best position is on the window edge (a ridge
+                # can carry the peak further than refine_radius from the up-scaled candidate)
+                for _ in range(8):
+                    x0, x1 = np.clip([x - refine_radius, x + refine_radius], 0, max_x)
+                    y0, y1 = np.clip([y - refine_radius, y + refine_radius], 0, max_y)
+                    scores = score_map(img[y0:y1 + h, x0:x1 + w], tpl)
+                    evaluated += scores.size
+                    dy, dx = np.unravel_index(np.argmax(scores), scores.shape)
+                    x, y = int(x0 + dx), int(y0 + dy)
+                    if not (x in (x0, x1) and 0 < x < max_x or y in (y0, y1) and 0 < y < max_y):
+                        break
+                refined[(x, y)] = max(refined.get((x, y), -np.inf), float(scores[dy, dx]))
+            best = sorted(((score, x, y) for (x, y), score in refined.items()), key=lambda c: (-c[0], c[2], c[1]))
+
+        score, x, y = best[0]
+        exhaustive = (image_levels[0].shape[0] - h + 1) * (image_levels[0].shape[1] - w + 1)
+        report = {"levels": len(image_levels) - 1, "evaluated": evaluated, "exhaustive": exhaustive,
+                  "skipped": 1 - evaluated / exhaustive}
+        return (x, y), (score if method == "NCC" else -score), report
+
+    @staticmethod
+    def transformed_match(image, template, method="NCC", scales=(0.75, 1.0, 1.25), angles=(0,),
+                          screen_levels=2, survivors=3):
+        """
+        Search the template over a set of scales and rotation angles (degrees, counter-clockwise).
+        The image is prepared once (FFT and summed-area tables, plus a `screen_levels` times pyrDown
+        copy) and reused by every hypothesis. Rotated templates are scored on their own pixels only,
+        through a mask. Hypotheses are screened on the reduced image first and only the `survivors`
+        best go to full resolution (templates too small to screen always do). For SSD, a hypothesis
+        is also skipped when the Cauchy–Schwarz bound (√Σw² − √ΣT²)² shows it cannot beat the current best.
+        SSD is compared per template pixel, so that different scales are comparable.
+        Returns the best (x, y, scale, angle), with x, y the centre of the matched template, its
+        score, and one record per hypothesis with its scores, whether it was pruned, and the time spent on it.
+        """
+        if method not in ("SSD", "NCC"):
+            raise ValueError(f"Unknown matching method: {method}")
+
+        def score_map(prepared, tpl, mask, window_energy=None):
+            # Higher is better for both methods
+            if method == "NCC":
+                return prepared.ncc_map(tpl) if mask is None else prepared.masked_ncc_map(tpl, mask)
+            n = tpl.size if mask is None else mask.sum()
+            if mask is None:
+                return -prepared.ssd_map(tpl, window_energy) / n
+            return -prepared.masked_ssd_map(tpl, mask, window_energy) / n
+
+        template = TemplateMatching._gray(template)
+        prepared = PreparedImage(image)
+        coarse_gray = prepared.gray
+        for _ in range(screen_levels):
+            coarse_gray = cv2.pyrDown(coarse_gray)
+        coarse = PreparedImage(coarse_gray)
+
+        # Screening on the reduced image
+        hypotheses = []
+        for scale in scales:
+            for angle in angles:
+                start_time = time.time()
+                record = {"scale": scale, "angle": angle, "coarse_score": None, "score": None, "pruned": False}
+                # Reduced exactly like the image, so that both went through the same filters
+                tpl, mask = TemplateMatching._transform_template(template, scale, angle)
+                for _ in range(screen_levels):
+                    tpl = cv2.pyrDown(tpl)
+                    mask = None if mask is None else cv2.pyrDown(mask)
+                if mask is not None:
+                    mask = (mask > 0.99).astype(np.float64)  # Drop pixels blurred with the outside
+                if min(tpl.shape) >= 8 and (mask is None or mask.any()) and tpl.shape[0] <= coarse.shape[0] and tpl.shape[1] <= coarse.shape[1]:
+                    record["coarse_score"] = float(score_map(coarse, tpl, mask).max())
+                record["seconds"] = time.time() - start_time
+                hypotheses.append(record)
+
+        screened = sorted((r for r in hypotheses if r["coarse_score"] is not None), key=lambda r: -r["coarse_score"])
+        for record in screened[survivors:]:
+            record["pruned"] = True
+
+        # Full resolution, most promising first
+        best, best_score = None, -np.inf
+        for record in [r for r in hypotheses if r["coarse_score"] is None] + screened[:survivors]:
+            start_time = time.time()
+            tpl, mask = TemplateMatching._transform_template(template, record["scale"], record["angle"])
+            if tpl.shape[0] > prepared.shape[0] or tpl.shape[1] > prepared.shape[1]:
+                record["pruned"] = True  # Does not fit in the image
+            else:
+                window_energy = None
+                if method == "SSD":
+                    # Lower bound of the per-pixel SSD at every position, from window energies alone
+                    n = tpl.size if mask is None else mask.sum()
+                    if mask is None:
+                        window_energy = prepared.window_energy(*tpl.shape)
+                    else:
+                        window_energy = prepared.masked_window_energy(mask)
+                    template_norm = np.sqrt(np.sum((tpl if mask is None else tpl * mask) ** 2))
+                    bound = np.min((np.sqrt(window_energy) - template_norm) ** 2) / n
+                    record["pruned"] = bool(-bound <= best_score)
+
+                if not record["pruned"]:
+                    scores = score_map(prepared, tpl, mask, window_energy)
+                    y, x = np.unravel_index(np.argmax(scores), scores.shape)
+                    record["score"] = float(scores[y, x]) if method == "NCC" else -float(scores[y, x])
+                    if scores[y, x] > best_score:
+                        best_score = float(scores[y, x])
+                        h, w = tpl.shape
+                        best = (x + (w - 1) / 2, y + (h - 1) / 2, record["scale"], record["angle"])
+            record["seconds"] += time.time() - start_time
+
+        if best is None:
+            return None, None, hypotheses
+        return best, (best_score if method == "NCC" else -best_score), hypotheses
+
+    @staticmethod
+    def _transform_template(template, scale, angle):
+        """
+        Template resized by scale and rotated by angle (degrees) inside its enlarged bounding box.
+        Returns the transformed template and a 0/1 mask of its valid pixels (None without rotation).
+        """
+        h, w = template.shape
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        scaled = cv2.resize(template, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        if angle % 360 == 0:
+            return scaled, None
+
+        sw, sh = size
+        rotation = cv2.getRotationMatrix2D(((sw - 1) / 2, (sh - 1) / 2), angle, 1.0)
+        cos, sin = abs(rotation[0, 0]), abs(rotation[0, 1])
+        bw, bh = int(np.ceil(sw * cos + sh * sin)), int(np.ceil(sw * sin + sh * cos))
+        rotation[0, 2] += (bw - sw) / 2
+        rotation[1, 2] += (bh - sh) / 2
+        rotated = cv2.warpAffine(scaled, rotation, (bw, bh), flags=cv2.INTER_LINEAR)
+        mask = cv2.warpAffine(np.ones_like(scaled, dtype=np.float64), rotation, (bw, bh), flags=cv2.INTER_NEAREST)
+        return rotated, mask
+
+    @staticmethod
+    def _top_candidates(scores, k, suppress_h, suppress_w):
+        """
+        Up to k (score, x, y) maxima of a score map, best first. Each pick suppresses the positions
+        within suppress_h/suppress_w of it, so the candidates are not all on the same peak.
+        """
+        scores = scores.copy()
+        found = []
+        for _ in range(k):
+            y, x = np.unravel_index(np.argmax(scores), scores.shape)
+            if not np.isfinite(scores[y, x]):
+                break
+            found.append((float(scores[y, x]), int(x), int(y)))
+            scores[max(0, y - suppress_h):y + suppress_h + 1, max(0, x - suppress_w):x + suppress_w + 1] = -np.inf
+        return found
+
+    @staticmethod
+    def _gray(image):
+        """Grayscale float64 copy of a BGR or single-channel image."""
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image.astype(np.float64)
 
-            # Find location of max NCC (best match)
-            max_loc = np.unravel_index(np.argmax(ncc_map), ncc_map.shape)
-            top_left = max_loc[::-1]
-            bottom_right = (top_left[0] + w, top_left[1] + h)
-            cv2.rectangle(output, top_left, bottom_right, (0, 255, 0), 2)
 
-        return output
\ No newline at end of file
+class PreparedImage:
+    """
+    Image-side work of template matching, done once and shared by every template searched in the
+    same image: the grayscale image, its FFT and the summed-area tables of its values and squares
+    (each computed on first use). The FFT is sized to the image, which serves templates of any
+    size: circular wrap-around only reaches positions where the template does not fit.
+    """
+
+    def __init__(self, image):
+        self.gray = TemplateMatching._gray(image)
+        img_h, img_w = self.gray.shape
+        self.fft_shape = (fft.next_fast_len(img_h, real=True), fft.next_fast_len(img_w, real=True))
+
+    @property
+    def shape(self):
+        return self.gray.shape
+
+    @cached_property
+    def spectrum(self):
+        return fft.rfft2(self.gray, self.fft_shape, workers=-1)
+
+    @cached_property
+    def spectrum_sq(self):
+        """FFT of the squared image, for window energies under a mask."""
+        return fft.rfft2(self.gray ** 2, self.fft_shape, workers=-1)
+
+    @cached_property
+    def integral(self):
+        """Summed-area table of the image, with a leading row and column of zeros."""
+        return cv2.integral(self.gray, sdepth=cv2.CV_64F)
+
+    @cached_property
+    def integral_sq(self):
+        """Summed-area table of the squared image."""
+        return cv2.integral(self.gray ** 2, sdepth=cv2.CV_64F)
+
+    def correlate(self, template, workers=-1, squared=False):
+        """
+        Valid cross-correlation Σ T(a, b)·I(y + a, x + b): one template FFT and one inverse FFT.
+        With squared, the correlation is taken with the squared image I².
+        """
+        img_h, img_w = self.shape
+        h, w = template.shape
+        image_spectrum = self.spectrum_sq if squared else self.spectrum
+        spectrum = image_spectrum * np.conj(fft.rfft2(template, self.fft_shape, workers=workers))
+        return fft.irfft2(spectrum, self.fft_shape, workers=workers)[:img_h - h + 1, :img_w - w + 1]
+
+    def window_energy(self, h, w):
+        """Σw² of every h x w window that fits."""
+        return self._window_sums(self.integral_sq, h, w)
+
+    def window_variance(self, h, w):
+        """(Σw², Σ(w − μw)²) of every h x w window that fits."""
+        energy = self.window_energy(h, w)
+        return energy, energy - self._window_sums(self.integral, h, w) ** 2 / (h * w)
+
+    def ssd_map(self, template, window_energy=None, workers=-1):
+        """SSD map of a template (see TemplateMatching.ssd_map). window_energy may be shared by same-size templates."""
+        template = TemplateMatching._gray(template)
+        h, w = template.shape
+        if window_energy is None:
+            window_energy = self.window_energy(h, w)
+
+        ssd = window_energy - 2 * self.correlate(template, workers) + np.sum(template ** 2)
+        return np.maximum(ssd, 0).astype(np.float32)  # FFT rounding can dip slightly below zero
+
+    def ncc_map(self, template, window_variance=None, workers=-1):
+        """NCC map of a template (see TemplateMatching.ncc_map). window_variance may be shared by same-size templates."""
+        template = TemplateMatching._gray(template)
+        h, w = template.shape
+        window_energy, variance = self.window_variance(h, w) if window_variance is None else window_variance
+
+        template_centered = template - np.mean(template)
+        template_energy = np.sum(template_centered ** 2)
+        numerator = self.correlate(template_centered, workers)
+
+        # Relative tolerance: flat windows leave only rounding noise of the summed-area tables
+        defined = (variance > 1e-10 * window_energy) & (template_energy > 0)
+        denominator = np.sqrt(np.maximum(variance, 0) * template_energy)
+        ncc = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=defined)
+        return np.clip(ncc, -1, 1).astype(np.float32)
+
+    def masked_window_energy(self, mask, workers=-1):
+        """Σ M·w² of every window, M a 0/1 mask of the template's valid pixels."""
+        return np.maximum(self.correlate(mask, workers, squared=True), 0)
+
+    def masked_ssd_map(self, template, mask, window_energy=None, workers=-1):
+        """SSD map counting only the template pixels where mask is set (e.g. a rotated template)."""
+        template = TemplateMatching._gray(template) * mask
+        if window_energy is None:
+            window_energy = self.masked_window_energy(mask, workers)
+        ssd = window_energy - 2 * self.correlate(template, workers) + np.sum(template ** 2)
+        return np.maximum(ssd, 0).astype(np.float32)
+
+    def masked_ncc_map(self, template, mask, workers=-1):
+        """
+        NCC map over the template pixels where mask is set. Window sums and energies under the mask
+        are FFT correlations of the mask with the image and the squared image.
+        """
+        template = TemplateMatching._gray(template)
+        mask = mask.astype(np.float64)
+        n = mask.sum()
+
+        template_centered = (template - template[mask > 0].mean()) * mask
+        template_energy = np.sum(template_centered ** 2)
+        numerator = self.correlate(template_centered, workers)
+        window_sum = self.correlate(mask, workers)
+        window_energy = self.masked_window_energy(mask, workers)
+        variance = window_energy - window_sum ** 2 / n
+
+        # FFT rounding noise scales with the image energy, not the window's: absolute tolerance
+        defined = (variance > 1e-12 * n * max(self.gray.max(), 1) ** 2) & (template_energy > 0)
+        denominator = np.sqrt(np.maximum(variance, 0) * template_energy)
+        ncc = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=defined)
+        return np.clip(ncc, -1, 1).astype(np.float32)
+
+    @staticmethod
+    def _window_sums(integral, h, w):
+        """Sum over every h x w window that fits, from a summed-area table."""
+        return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import tempfile
+import time
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from app.processing.keypoint_set import KeypointSet, KEYPOINT_DTYPE
+
+
+class FeatureCache:
+    """
+    Persistent on-disk cache of SIFT keypoints and descriptors.
+
+    Entries are keyed by a hash of the image content plus the full SIFT parameter tuple, so the
+    same image extracted with the same settings is never computed twice, across runs and processes.
+    The cache is size bounded: least recently used entries are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, cache_dir: str = "Cache/sift_features", max_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image: np.ndarray, parameters: tuple) -> str:
+        """Content hash of the image (pixels, shape and dtype) combined with the SIFT parameters."""
+        digest = hashlib.sha256()
+        digest.update(repr((image.shape, str(image.dtype), parameters)).encode())
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[KeypointSet, np.ndarray]]:
+        """Return the cached (keypoints, descriptors) for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                if entry["keypoints"].dtype != KEYPOINT_DTYPE:
+                    raise ValueError(f"Outdated cache entry: {path}")
+                keypoints, descriptors = KeypointSet(entry["keypoints"]), entry["descriptors"]
+            os.utime(path)  # Mark as recently used
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return keypoints, descriptors
+
+    def put(self, key: str, keypoints: Union[KeypointSet, list], descriptors: np.ndarray):
+        """Store an entry atomically, then evict old entries if the cache grew too large."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, keypoints=KeypointSet.from_cv2(keypoints).data, descriptors=np.asarray(descriptors))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._evict()
+
+    def extract_features(self, sift_srv, image: np.ndarray) -> Tuple[KeypointSet, np.ndarray, float]:
+        """
+        Drop-in replacement for sift_srv.extract_features that only runs the extraction on a miss.
+        Returns keypoints, descriptors, and computation time (lookup time on a hit).
+        """
+        start_time = time.time()
+        key = self.key(image, sift_srv.parameter_tuple())
+
+        cached = self.get(key)
+        if cached is not None:
+            keypoints, descriptors = cached
+            return keypoints, descriptors, time.time() - start_time
+
+        keypoints, descriptors, computation_time = sift_srv.extract_features(image)
+        self.put(key, keypoints, descriptors)
+        return keypoints, descriptors, computation_time
+
+    def clear(self):
+        """Remove every cached entry and reset the counters."""
+        for path, _, _ in self._entries():
+            self._remove(path)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        """(path, size, last use) of every entry."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Already evicted by another process
@@ -0,0 +1,205 @@
+import os
+import tempfile
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from app.processing.descriptor_index import KMeansTree
+from app.processing.sift import SIFTService
+from app.services.feature_cache import FeatureCache
+
+
+class ImageRetrieval:
+    """
+    Image retrieval over a stored gallery with a vocabulary tree.
+
+    A hierarchical k-means vocabulary (its leaves are the visual words) is trained on the SIFT
+    descriptors of a folder. Every gallery image is stored as word counts in an inverted file, weighted
+    by TF-IDF. A query only visits the inverted lists of the words it contains, and full descriptor
+    matching is run on the best few candidates only.
+    """
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+    def __init__(self, sift_srv: SIFTService = None, feature_cache: FeatureCache = None,
+                 branching: int = 10, depth: int = 3):
+        self.sift_srv = sift_srv if sift_srv is not None else SIFTService()
+        # Gallery descriptors are not kept in memory; query verification reloads them from the cache
+        self.feature_cache = feature_cache if feature_cache is not None else FeatureCache()
+        self.vocabulary = KMeansTree(branching=branching, depth=depth)
+        self.image_paths = []
+        # Raw word counts of every gallery image, kept so that new images only need their own extraction
+        self._image_words = []
+        self._image_counts = []
+        # Inverted file: word w owns postings _word_offsets[w]:_word_offsets[w + 1]
+        self.idf = None
+        self._word_offsets = None
+        self._posting_images = None
+        self._posting_weights = None
+
+    @property
+    def num_words(self) -> int:
+        return self.vocabulary.num_leaves
+
+    @classmethod
+    def list_images(cls, folder: str) -> List[str]:
+        """Image files directly inside a folder, sorted by name."""
+        return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                      if name.lower().endswith(cls.IMAGE_EXTENSIONS))
+
+    def train(self, folder: str) -> "ImageRetrieval":
+        """
+        Train the vocabulary on every image of a folder and index those images. The vocabulary is fit
+        on at most vocabulary.max_train_samples descriptors, an equal random share from every image.
+        Every image is extracted once: its descriptors are spilled to a temporary file (about 0.5 KB per
+        keypoint) and read back through a memory map for indexing, so memory holds one image at a time.
+        """
+        paths = self.list_images(folder)
+        rng = np.random.default_rng(self.vocabulary.seed)
+        per_image = max(1, self.vocabulary.max_train_samples // max(len(paths), 1))
+        sample, lengths, dim = [], [], 128
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            spill_path = os.path.join(spill_dir, "descriptors.f32")
+            with open(spill_path, "wb") as spill:
+                for path in paths:
+                    descriptors = np.ascontiguousarray(self._features(path)[1], dtype=np.float32)
+                    if len(descriptors):
+                        dim = descriptors.shape[1]
+                        spill.write(descriptors.data)
+                    lengths.append(len(descriptors))
+                    if len(descriptors) > per_image:
+                        descriptors = descriptors[rng.choice(len(descriptors), per_image, replace=False)]
+                    sample.append(descriptors)
+            self.vocabulary.fit(np.concatenate([d for d in sample if len(d)]))
+            del sample
+
+            offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.intp)
+            spilled = np.memmap(spill_path, dtype=np.float32, mode='r', shape=(int(offsets[-1]), dim))
+            self.image_paths, self._image_words, self._image_counts = [], [], []
+            self._add(paths, (spilled[offsets[i]:offsets[i + 1]] for i in range(len(paths))))
+            del spilled  # Closes the map before the directory is removed
+        return self
+
+    def add_images(self, paths: Sequence[str]) -> "ImageRetrieval":
+        """Index more images with the trained vocabulary."""
+        self._add(paths)
+        return self
+
+    def query(self, image: np.ndarray, top_k: int = 10, verify: int = 5,
+              ratio: float = 0.8) -> List[Tuple[str, float, Optional[int]]]:
+        """
+        Best matching gallery images for a query image, as (path, tf-idf score, verified matches).
+        The `verify` best candidates are re-ranked by their number of ratio-test/mutual descriptor matches;
+        the other candidates keep None and follow in score order.
+        """
+        keypoints, descriptors, _ = self._extract(image)
+        scores = self.score(descriptors)
+
+        candidates = np.argsort(-scores, kind='stable')[:top_k]
+        results = []
+        for rank, image_idx in enumerate(candidates.tolist()):
+            matches = None
+            if rank < verify and len(descriptors):
+                _, gallery_descriptors = self._features(self.image_paths[image_idx])
+                matches = len(self.sift_srv.ratio_match(descriptors, gallery_descriptors, ratio=ratio))
+            results.append((self.image_paths[image_idx], float(scores[image_idx]), matches))
+
+        verified = sorted(results[:verify], key=lambda result: -result[2] if result[2] is not None else 0)
+        return verified + results[verify:]
+
+    def score(self, descriptors: np.ndarray) -> np.ndarray:
+        """TF-IDF cosine similarity of the query descriptors to every gallery image."""
+        scores = np.zeros(len(self.image_paths))
+        if len(descriptors) == 0 or not self.image_paths:
+            return scores
+
+        words, query_weights = self._weights(*self._word_counts(descriptors))
+
+        # Only the inverted lists of the query words are visited
+        lo, hi = self._word_offsets[words], self._word_offsets[words + 1]
+        lengths = hi - lo
+        postings = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        contributions = self._posting_weights[postings] * np.repeat(query_weights, lengths)
+        return np.bincount(self._posting_images[postings], weights=contributions, minlength=len(self.image_paths))
+
+    def save(self, path: str):
+        """Store the vocabulary and the inverted file (word counts of every gallery image)."""
+        lengths = np.array([len(words) for words in self._image_words], dtype=np.intp)
+        np.savez(path,
+                 branching=self.vocabulary.branching, depth=self.vocabulary.depth,
+                 centroids=np.concatenate(self.vocabulary.centroids),
+                 image_paths=np.array(self.image_paths), lengths=lengths,
+                 words=np.concatenate(self._image_words) if self._image_words else np.zeros(0, np.intp),
+                 counts=np.concatenate(self._image_counts) if self._image_counts else np.zeros(0, np.intp))
+
+    def load(self, path: str) -> "ImageRetrieval":
+        """Restore a vocabulary and gallery written by save()."""
+        with np.load(path) as data:
+            branching, depth = int(data["branching"]), int(data["depth"])
+            self.vocabulary = KMeansTree(branching=branching, depth=depth)
+            sizes = np.cumsum([branching ** (level + 1) for level in range(depth)])[:-1]
+            self.vocabulary.centroids = np.split(data["centroids"], sizes)
+
+            splits = np.cumsum(data["lengths"])[:-1]
+            self.image_paths = data["image_paths"].tolist()
+            self._image_words = np.split(data["words"], splits) if self.image_paths else []
+            self._image_counts = np.split(data["counts"], splits) if self.image_paths else []
+
+        self._build_inverted_file()
+        return self
+
+    def _add(self, paths: Sequence[str], descriptors: Iterable[np.ndarray] = None):
+        """
+        Index images one at a time: only the word counts of each image are kept. Descriptors are
+        extracted per image unless given (one array per path, consumed lazily).
+        """
+        if descriptors is None:
+            descriptors = (self._features(path)[1] for path in paths)
+        for path, image_descriptors in zip(paths, descriptors):
+            words, counts = self._word_counts(image_descriptors)
+            self.image_paths.append(path)
+            self._image_words.append(words)
+            self._image_counts.append(counts)
+        self._build_inverted_file()
+
+    def _word_counts(self, descriptors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Distinct visual words of a descriptor set and how often each occurs."""
+        if len(descriptors) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        return np.unique(self.vocabulary.assign(descriptors), return_counts=True)
+
+    def _weights(self, words: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """L2-normalized TF-IDF weights of a word histogram (words unseen in the gallery weigh 0)."""
+        weights = counts / max(counts.sum(), 1) * self.idf[words]
+        norm = np.linalg.norm(weights)
+        return words, weights / norm if norm > 0 else weights
+
+    def _build_inverted_file(self):
+        """Recompute IDF and the TF-IDF weighted postings of all gallery images."""
+        num_images = len(self.image_paths)
+        all_words = np.concatenate(self._image_words) if self._image_words else np.zeros(0, np.intp)
+        document_frequency = np.bincount(all_words, minlength=self.num_words)
+        with np.errstate(divide='ignore'):
+            self.idf = np.where(document_frequency > 0, np.log(num_images / np.maximum(document_frequency, 1)), 0.0)
+
+        images, weights = [], []
+        for image_idx, (words, counts) in enumerate(zip(self._image_words, self._image_counts)):
+            weights.append(self._weights(words, counts)[1])
+            images.append(np.full(len(words), image_idx, dtype=np.intp))
+
+        order = np.argsort(all_words, kind='stable')
+        self._posting_images = np.concatenate(images)[order] if images else np.zeros(0, np.intp)
+        self._posting_weights = np.concatenate(weights)[order] if weights else np.zeros(0)
+        self._word_offsets = np.concatenate([[0], np.cumsum(document_frequency)])
+
+    def _extract(self, image: np.ndarray):
+        return self.feature_cache.extract_features(self.sift_srv, image)
+
+    def _features(self, path: str):
+        image = cv2.imread(path)
+        if image is None:
+            raise ValueError(f"Could not read image: {path}")
+        keypoints, descriptors, _ = self._extract(image)
+        return keypoints, descriptors
@@ -0,0 +1,165 @@
+import multiprocessing
+import os
+import sqlite3
+from multiprocessing import shared_memory
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from app.processing.sift import SIFTService
+from app.services.feature_cache import FeatureCache
+from app.services.image_retrieval import ImageRetrieval
+
+# Per-process state of pool workers, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(settings: dict, cache_dir: Optional[str], shm_name: Optional[str] = None,
+                 offsets: Optional[np.ndarray] = None, dim: int = 128):
+    sift_srv = SIFTService()
+    sift_srv.__dict__.update(settings)
+    _worker["sift_srv"] = sift_srv
+    _worker["feature_cache"] = FeatureCache(cache_dir) if cache_dir is not None else None
+    if shm_name is not None:
+        # Attach to the descriptors of every image once; pair jobs only take views of it
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker["descriptors"] = np.ndarray((offsets[-1], dim), dtype=np.float32, buffer=shm.buf)
+        _worker["offsets"] = offsets
+        _worker["shm"] = shm  # Released after the view above
+
+
+def _extract_job(path: str) -> np.ndarray:
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"Could not read image: {path}")
+    if _worker["feature_cache"] is not None:
+        _, descriptors, _ = _worker["feature_cache"].extract_features(_worker["sift_srv"], image)
+    else:
+        _, descriptors, _ = _worker["sift_srv"].extract_features(image)
+    if len(descriptors) == 0:
+        # Images without keypoints (and cache entries made from them) come back as shape (0,)
+        return np.zeros((0, 128), dtype=np.float32)
+    return np.asarray(descriptors, dtype=np.float32)
+
+
+def _pair_job(job: Tuple[Sequence[Tuple[int, int]], float, bool, str]) -> List[Tuple[int, int, np.ndarray]]:
+    pairs, ratio, mutual, method = job
+    descriptors, offsets = _worker["descriptors"], _worker["offsets"]
+    results = []
+    for i, j in pairs:
+        matches = _worker["sift_srv"].ratio_match(descriptors[offsets[i]:offsets[i + 1]],
+                                                  descriptors[offsets[j]:offsets[j + 1]],
+                                                  ratio=ratio, mutual=mutual, method=method)
+        results.append((i, j, np.array([(m.queryIdx, m.trainIdx) for m in matches], dtype=np.int32).reshape(-1, 2)))
+    return results
+
+
+class PairwiseMatcher:
+    """
+    All-pairs matching of the images in a folder (duplicate detection, match graphs).
+
+    Features are extracted once per image, then all descriptors are placed in one
+    multiprocessing.shared_memory block that every worker process maps without copying. Image pairs
+    are cut into small jobs on a shared queue: an idle worker takes the next job, so fast and slow
+    pairs balance out across processes. Every finished job is committed to an SQLite match table
+    right away, and a new run on the same table skips the pairs already stored.
+    """
+
+    def __init__(self, sift_srv: SIFTService = None, cache_dir: Optional[str] = None, num_workers: int = None,
+                 ratio: float = 0.8, mutual: bool = True, method: str = "SSD", pairs_per_job: int = 32):
+        self.sift_srv = sift_srv if sift_srv is not None else SIFTService()
+        self.cache_dir = cache_dir  # Optional FeatureCache directory shared by the workers
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count() or 1
+        self.ratio = ratio
+        self.mutual = mutual
+        self.method = method
+        self.pairs_per_job = pairs_per_job
+
+    def run(self, folder: str, table_path: str) -> int:
+        """Match every pair of images in folder into table_path. Returns the number of pairs computed now."""
+        paths = ImageRetrieval.list_images(folder)
+        connection = self._open_table(table_path)
+        try:
+            done = set(connection.execute("SELECT image1, image2 FROM pair_matches").fetchall())
+            pending = [(i, j) for i in range(len(paths)) for j in range(i + 1, len(paths))
+                       if (paths[i], paths[j]) not in done]
+            if not pending:
+                return 0
+
+            # Extract only the images that still take part in a pending pair
+            needed = sorted({i for pair in pending for i in pair})
+            descriptors = [np.zeros((0, 128), dtype=np.float32)] * len(paths)
+            for i, image_descriptors in zip(needed, self._map(_extract_job, [paths[i] for i in needed])):
+                descriptors[i] = image_descriptors
+            dim = next((d.shape[1] for d in descriptors if len(d)), 128)
+            offsets = np.concatenate([[0], np.cumsum([len(d) for d in descriptors])]).astype(np.intp)
+
+            shm = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]) * dim * 4, 1))
+            try:
+                shared = np.ndarray((offsets[-1], dim), dtype=np.float32, buffer=shm.buf)
+                for i, image_descriptors in enumerate(descriptors):
+                    shared[offsets[i]:offsets[i + 1]] = image_descriptors
+                del shared, descriptors
+
+                jobs = [(pending[start:start + self.pairs_per_job], self.ratio, self.mutual, self.method)
+                        for start in range(0, len(pending), self.pairs_per_job)]
+                for results in self._map(_pair_job, jobs, shm.name, offsets, dim, ordered=False):
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO pair_matches VALUES (?, ?, ?, ?)",
+                        [(paths[i], paths[j], len(matches), matches.tobytes()) for i, j, matches in results])
+                    connection.commit()
+            finally:
+                shm.close()
+                shm.unlink()
+        finally:
+            connection.close()
+
+        return len(pending)
+
+    @staticmethod
+    def load_table(table_path: str) -> List[Tuple[str, str, int]]:
+        """(image1, image2, number of matches) of every stored pair."""
+        connection = sqlite3.connect(table_path)
+        try:
+            return connection.execute("SELECT image1, image2, num_matches FROM pair_matches ORDER BY image1, image2").fetchall()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def load_matches(table_path: str, image1: str, image2: str) -> Optional[np.ndarray]:
+        """(N, 2) (queryIdx, trainIdx) descriptor matches of a stored pair, or None if it was not matched."""
+        connection = sqlite3.connect(table_path)
+        try:
+            row = connection.execute("SELECT matches FROM pair_matches WHERE image1 = ? AND image2 = ?",
+                                     (image1, image2)).fetchone()
+        finally:
+            connection.close()
+        return None if row is None else np.frombuffer(row[0], dtype=np.int32).reshape(-1, 2)
+
+    @staticmethod
+    def _open_table(table_path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(table_path)
+        connection.execute("CREATE TABLE IF NOT EXISTS pair_matches ("
+                           "image1 TEXT, image2 TEXT, num_matches INTEGER, matches BLOB, "
+                           "PRIMARY KEY (image1, image2))")
+        connection.commit()
+        return connection
+
+    def _map(self, fn, items: list, shm_name: str = None, offsets: np.ndarray = None, dim: int = 128,
+             ordered: bool = True):
+        """fn over items in worker processes (in this process when num_workers is 1), results streamed back."""
+        settings = {key: value for key, value in vars(self.sift_srv).items() if key not in ("_executor", "arena")}
+        settings["num_workers"] = 1  # Parallelism comes from the processes
+        init_args = (settings, self.cache_dir, shm_name, offsets, dim)
+
+        if self.num_workers == 1:
+            _init_worker(*init_args)
+            try:
+                yield from map(fn, items)
+            finally:
+                _worker.clear()
+            return
+
+        with multiprocessing.get_context().Pool(self.num_workers, initializer=_init_worker, initargs=init_args) as pool:
+            yield from (pool.imap if ordered else pool.imap_unordered)(fn, items, chunksize=1)
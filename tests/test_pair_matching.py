@@ -0,0 +1,33 @@
+import os
+
+import cv2
+import numpy as np
+
+from app.services.pair_matching import PairwiseMatcher
+
+
+def _write_images(folder):
+    rng = np.random.default_rng(0)
+    texture = cv2.GaussianBlur((rng.random((120, 160)) * 255).astype(np.uint8), (0, 0), 2)
+    texture = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX)
+    cv2.imwrite(str(folder / "a.png"), texture)
+    cv2.imwrite(str(folder / "b.png"), np.roll(texture, 5, axis=1))
+    cv2.imwrite(str(folder / "blank.png"), np.full((100, 100), 128, dtype=np.uint8))  # No keypoints
+
+
+def test_run_with_an_image_without_keypoints(tmp_path):
+    folder = tmp_path / "images"
+    folder.mkdir()
+    _write_images(folder)
+    cache_dir = str(tmp_path / "cache")
+
+    # Second run reads the empty descriptors back from the feature cache
+    for table in ("first.db", "second.db"):
+        table_path = str(tmp_path / table)
+        assert PairwiseMatcher(cache_dir=cache_dir, num_workers=1).run(str(folder), table_path) == 3
+
+        rows = {(os.path.basename(image1), os.path.basename(image2)): count
+                for image1, image2, count in PairwiseMatcher.load_table(table_path)}
+        assert rows[("a.png", "blank.png")] == 0
+        assert rows[("b.png", "blank.png")] == 0
+        assert rows[("a.png", "b.png")] > 0
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+
+from app.processing.sift import SIFTService
+
+
+def _textured_image(seed: int = 0, shape=(96, 128)) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur((rng.random(shape) * 255).astype(np.uint8), (0, 0), 2)
+
+
+def _loop_keypoints(service: SIFTService, dog_pyramid) -> set:
+    """The original per-pixel detector: (x, y, size) of every extremum that passes the checks."""
+    found = set()
+    edge_ratio = (service.edge_threshold + 1) ** 2 / service.edge_threshold
+    for octave_idx, octave in enumerate(dog_pyramid):
+        for scale_idx in range(1, len(octave) - 1):
+            prev, current, following = octave[scale_idx - 1:scale_idx + 2]
+            h, w = current.shape
+            for i in range(1, h - 1):
+                for j in range(1, w - 1):
+                    val = current[i, j]
+                    if abs(val) <= service.contrast_threshold:
+                        continue
+                    cube = np.stack([prev[i - 1:i + 2, j - 1:j + 2], current[i - 1:i + 2, j - 1:j + 2],
+                                     following[i - 1:i + 2, j - 1:j + 2]])
+                    if not ((val > 0 and val >= cube.max()) or (val < 0 and val <= cube.min())):
+                        continue
+                    Dxx = current[i, j + 1] + current[i, j - 1] - 2 * val
+                    Dyy = current[i + 1, j] + current[i - 1, j] - 2 * val
+                    Dxy = (current[i + 1, j + 1] + current[i - 1, j - 1] -
+                           current[i + 1, j - 1] - current[i - 1, j + 1]) / 4
+                    trace, det = Dxx + Dyy, Dxx * Dyy - Dxy * Dxy
+                    if det <= 0 or trace ** 2 / det >= edge_ratio:
+                        continue
+                    scale_factor = 2 ** octave_idx
+                    size = np.float32(service.sigma * service.k ** scale_idx * scale_factor)  # KeypointSet stores float32
+                    found.add((j * scale_factor, i * scale_factor, float(size)))
+    return found
+
+
+def test_find_keypoints_matches_loop():
+    service = SIFTService()
+    service.accelerated = False
+    service.update_parameters(contrast_threshold=0.01, max_keypoints=None)  # Enough extrema on a tiny image
+    dog_pyramid = service.build_dog_pyramid(service.build_gaussian_pyramid(_textured_image()))
+
+    keypoints = service.find_keypoints(dog_pyramid)
+    expected = _loop_keypoints(service, dog_pyramid)
+    actual = {(x, y, size) for x, y, size in zip(keypoints.data["x"].tolist(), keypoints.data["y"].tolist(),
+                                                  keypoints.data["size"].tolist())}
+    assert len(expected) > 0
+    assert len(actual) == len(keypoints)
+    assert actual == expected
+
+
+def _descriptors(seed: int, count: int) -> np.ndarray:
+    return np.random.default_rng(seed).random((count, 128), dtype=np.float32)
+
+
+def _match_tuples(matches) -> list:
+    return [(m.queryIdx, m.trainIdx, m.distance) for m in matches]
+
+
+def test_match_features_ssd_matches_loop():
+    descriptors1, descriptors2 = _descriptors(1, 60), _descriptors(2, 90)
+    best = [np.min(np.sum((descriptors2 - d) ** 2, axis=1)) for d in descriptors1]
+    threshold = float(np.median(best))
+
+    # The original loop: nearest neighbour of every query, kept when its SSD is within the threshold
+    expected = []
+    for i, desc1 in enumerate(descriptors1):
+        ssd = np.sum((descriptors2 - desc1) ** 2, axis=1)
+        j = np.argmin(ssd)
+        if ssd[j] <= threshold:
+            expected.append((i, int(j), float(ssd[j])))
+
+    service = SIFTService()
+    service.match_memory_budget = 16 * 90 * 4  # 16 query rows per block
+    actual = _match_tuples(service.match_features(descriptors1, descriptors2, "SSD", SSD_threshold=threshold))
+    assert [m[:2] for m in actual] == [m[:2] for m in expected]
+    np.testing.assert_allclose([m[2] for m in actual], [m[2] for m in expected], rtol=1e-5)
+
+
+def test_match_features_ncc_matches_loop():
+    descriptors1, descriptors2 = _descriptors(3, 40), _descriptors(4, 50)
+    descriptors2[:5] = descriptors1[:5] + 0.05 * _descriptors(5, 5)  # Some strong matches
+
+    # The original double loop: best NCC of every query, kept when it reaches the threshold
+    expected = []
+    for i, desc1 in enumerate(descriptors1):
+        desc1_centered = desc1 - np.mean(desc1)
+        ncc_list = []
+        for desc2 in descriptors2:
+            desc2_centered = desc2 - np.mean(desc2)
+            ncc_list.append(np.sum(desc1_centered * desc2_centered) /
+                            np.sqrt(np.sum(desc1_centered ** 2) * np.sum(desc2_centered ** 2)))
+        j = int(np.argmax(ncc_list))
+        if not ncc_list[j] < 0.2:
+            expected.append((i, j, float(-ncc_list[j])))
+
+    service = SIFTService()
+    service.match_memory_budget = 8 * 50 * 4  # 8 query rows per block
+    actual = _match_tuples(service.match_features(descriptors1, descriptors2, "NCC", NCC_threshold=0.2))
+    assert len(expected) > 5
+    assert [m[:2] for m in actual] == [m[:2] for m in expected]
+    np.testing.assert_allclose([m[2] for m in actual], [m[2] for m in expected], rtol=1e-5)
@@ -0,0 +1,47 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+
+from app.processing.sift import SIFTService
+
+
+def _service(accelerated: bool) -> SIFTService:
+    service = SIFTService()
+    service.accelerated = accelerated
+    service.contrast_threshold = 0.01  # Enough extrema on a small synthetic image
+    return service
+
+
+def test_find_octave_extrema_matches_numpy():
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur((rng.random((192, 256)) * 255).astype(np.uint8), (0, 0), 2)
+    numpy_service, numba_service = _service(False), _service(True)
+    dog_pyramid = numpy_service.build_dog_pyramid(numpy_service.build_gaussian_pyramid(image))
+    edge_ratio = (numpy_service.edge_threshold + 1) ** 2 / numpy_service.edge_threshold
+
+    found = 0
+    for octave in dog_pyramid:
+        dog = np.asarray(octave)
+        expected = numpy_service._find_octave_extrema(dog, edge_ratio)
+        actual = numba_service._find_octave_extrema(dog, edge_ratio)
+        for expected_idx, actual_idx in zip(expected, actual):
+            np.testing.assert_array_equal(actual_idx, expected_idx)
+        found += len(expected[0])
+    assert found > 0
+
+
+def test_describe_batch_matches_numpy():
+    rng = np.random.default_rng(1)
+    magnitude = rng.random((80, 80), dtype=np.float32)
+    orientation = rng.uniform(0, 360, (80, 80)).astype(np.float32)
+    orientation[::7, ::5] = 0  # Bin edges
+    orientation[::9, ::3] = 360
+    radius = rng.integers(4, 12, 50)
+    x = rng.integers(12, 68, 50)
+    y = rng.integers(12, 68, 50)
+
+    expected = _service(False)._describe_batch(magnitude, orientation, x, y, radius)
+    actual = _service(True)._describe_batch(magnitude, orientation, x, y, radius)
+    np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-7)
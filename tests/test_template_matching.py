@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+
+from app.processing.template_matching import TemplateMatching
+
+
+def _scene(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    image = cv2.GaussianBlur((rng.random((40, 52, 3)) * 255).astype(np.uint8), (0, 0), 1)
+    template = image[12:22, 20:28].copy()
+    return image, template
+
+
+def test_ssd_map_matches_loop():
+    image, template = _scene()
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    h, w = gray_template.shape
+
+    # The original sliding-window loop
+    expected = np.zeros((gray.shape[0] - h + 1, gray.shape[1] - w + 1), dtype=np.float32)
+    for y in range(expected.shape[0]):
+        for x in range(expected.shape[1]):
+            expected[y, x] = np.sum((gray[y:y + h, x:x + w] - gray_template) ** 2)
+
+    actual = TemplateMatching.ssd_map(image, template)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6 * np.sum(gray_template ** 2))  # FFT rounding scales with the energy
+    assert np.unravel_index(np.argmin(actual), actual.shape) == (12, 20)
+
+
+def test_ncc_map_matches_loop():
+    image, template = _scene(1)
+    image[:, :12] = 90  # Flat strip: windows inside it have zero variance
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    h, w = gray_template.shape
+
+    # The original sliding-window loop
+    template_centered = gray_template - np.mean(gray_template)
+    expected = np.zeros((gray.shape[0] - h + 1, gray.shape[1] - w + 1), dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for y in range(expected.shape[0]):
+            for x in range(expected.shape[1]):
+                window_centered = gray[y:y + h, x:x + w] - np.mean(gray[y:y + h, x:x + w])
+                expected[y, x] = np.sum(window_centered * template_centered) / np.sqrt(
+                    np.sum(window_centered ** 2) * np.sum(template_centered ** 2))
+
+    ncc_map, top_left = TemplateMatching.match_ncc(image, template)
+    flat = ~np.isfinite(expected)
+    assert flat[:, :12 - w + 1].all()
+    np.testing.assert_array_equal(ncc_map[flat], 0)  # Undefined NCC is reported as 0
+    np.testing.assert_allclose(ncc_map[~flat], expected[~flat], atol=1e-5)
+    assert top_left == (20, 12)